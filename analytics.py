@@ -0,0 +1,155 @@
+from array import array
+from itertools import accumulate, compress
+
+"""
+Aggregates and threshold events computed over whole model.Series columns
+Each function makes a fixed number of passes over a column using builtins
+rather than walking per-point dicts. Columns of NUMPY_MIN_POINTS or more
+are handed to NumPy when it is installed; Dark Sky's 61 minutes and 169
+hours are far cheaper to walk than NumPy is to import
+"""
+
+# precipProbability at or above which a point counts as raining
+RAIN_PROBABILITY = 0.5
+# Data points averaged when looking for the strongest gusts
+GUST_WINDOW = 3
+# Shortest column worth importing NumPy for
+NUMPY_MIN_POINTS = 10000
+
+_numpy = None
+
+
+def numpy_for(length):
+    """Returns the numpy module for a column of length points, or None to use builtins"""
+    global _numpy
+    if length < NUMPY_MIN_POINTS:
+        return None
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+
+def _values(series, field):
+    """Returns the field's column with missing values (NaN) replaced by 0"""
+    column = series.column(field)
+    numpy = numpy_for(len(column))
+    if numpy is not None:
+        return numpy.nan_to_num(numpy.frombuffer(column, dtype="d"))
+    return array("d", [value if value == value else 0.0 for value in column])
+
+
+def above(series, field, threshold):
+    """Returns a list of booleans, True where field is at or above threshold"""
+    column = series.column(field)
+    numpy = numpy_for(len(column))
+    if numpy is not None:
+        return (numpy.frombuffer(column, dtype="d") >= threshold).tolist()
+    # NaN compares False, so missing values never count as above
+    return [value >= threshold for value in column]
+
+
+def _edges(mask):
+    """Returns the indexes where mask turns True and where it turns False"""
+    numpy = numpy_for(len(mask))
+    if numpy is not None:
+        edges = numpy.diff(numpy.concatenate(([0], numpy.asarray(mask, dtype="b"), [0])))
+        return numpy.flatnonzero(edges == 1).tolist(), numpy.flatnonzero(edges == -1).tolist()
+    edges = list(map(int.__sub__, mask + [False], [False] + mask))
+    rises = list(compress(range(len(edges)), map((1).__eq__, edges)))
+    falls = list(compress(range(len(edges)), map((-1).__eq__, edges)))
+    return rises, falls
+
+
+def runs(series, mask):
+    """
+    Returns the (start, stop) times of each run of True in mask
+    stop is the time of the first point after the run, or None if the run
+    lasts until the end of the series
+    """
+    times = series.column("time")
+    rises, falls = _edges(mask)
+    return [(times[start], times[stop] if stop < len(times) else None)
+            for start, stop in zip(rises, falls)]
+
+
+def crossings(series, field, threshold):
+    """
+    Returns (time, 'above' or 'below') for each point where field crosses threshold,
+    in time order. A series that starts above threshold does not count as a crossing
+    """
+    times = series.column("time")
+    rises, falls = _edges(above(series, field, threshold))
+    events = [(times[index], "above") for index in rises if index > 0]
+    events.extend((times[index], "below") for index in falls if index < len(times))
+    return sorted(events)
+
+
+def rain_periods(series, probability=RAIN_PROBABILITY):
+    """Returns the (start, stop) times of each period where precipitation is likely"""
+    return runs(series, above(series, "precipProbability", probability))
+
+
+def count_above(series, field, threshold):
+    """Returns how many points (hours, minutes) have field at or above threshold"""
+    return sum(above(series, field, threshold))
+
+
+def rolling_sum(series, field, window):
+    """
+    Returns the sum of field over each window of consecutive points
+    The result has len(series) - window + 1 entries
+    """
+    values = _values(series, field)
+    if len(values) < window:
+        return array("d")
+    numpy = numpy_for(len(values))
+    if numpy is not None:
+        sums = numpy.concatenate(([0.0], numpy.cumsum(values)))
+        return array("d", (sums[window:] - sums[:-window]).tolist())
+    sums = array("d", accumulate(values, initial=0.0))
+    return array("d", map(float.__sub__, sums[window:], sums[:-window]))
+
+
+def max_window(series, field, window=GUST_WINDOW):
+    """
+    Returns (start time, mean) of the window of consecutive points with
+    the highest mean field, or None if the series is shorter than window
+    """
+    sums = rolling_sum(series, field, window)
+    if not sums:
+        return None
+    best = max(range(len(sums)), key=sums.__getitem__)
+    return series.column("time")[best], sums[best] / window
+
+
+def total(series, field):
+    """Returns the sum of field over the whole series"""
+    return float(sum(_values(series, field)))
+
+
+def accumulation(series):
+    """Returns the precipitation expected over the series (precipIntensity per hour times hours)"""
+    times = series.column("time")
+    if len(times) < 2:
+        return 0.0
+    return total(series, "precipIntensity") * (times[1] - times[0]) / 3600
+
+
+def summarize(series, heat=None):
+    """
+    Returns a dict of the headline aggregates for a minutely or hourly series:
+    rain periods, strongest gust window, expected precipitation and, if heat
+    is given, the number of points with temperature at or above it
+    """
+    summary = {
+        "rain": rain_periods(series),
+        "gust": max_window(series, "windGust") if "windGust" in series else None,
+        "precip_total": accumulation(series),
+    }
+    if heat is not None:
+        summary["heat"] = count_above(series, "temperature", heat)
+    return summary
@@ -0,0 +1,109 @@
+import gzip, json, os, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+"""
+Local stand-in for the Dark Sky and Google Maps APIs
+
+Serves the sample responses in bench/fixtures over plain HTTP. Point a
+transport.ConnectionPool at it with MockServer.route(pool). Forecast requests
+honour exclude= like Dark Sky does, and responses are gzipped when asked
+"""
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+HOSTS = ("api.darksky.net", "maps.googleapis.com", "www.googleapis.com")
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), "r", encoding="utf-8") as fixture:
+        return json.load(fixture)
+
+
+class MockServer(object):
+    """
+    Runs the stand-in server on a background thread. With alerts=True forecasts
+    carry the alert-heavy fixture's alerts instead of the single regular one
+    """
+    def __init__(self, alerts=False):
+        self.forecast = load_fixture("darksky_forecast.json")
+        if alerts:
+            self.forecast["alerts"] = load_fixture("darksky_alerts.json")["alerts"]
+        self.geocode = json.dumps(load_fixture("google_geocode.json")).encode("utf-8")
+        self.geolocate = json.dumps(load_fixture("google_geolocate.json")).encode("utf-8")
+        self.requests = 0
+        self.bodies = {}
+        self.compressed = {}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def route(self, pool):
+        """Sends the pool's requests for every API host to this server"""
+        for host in HOSTS:
+            pool.route(host, "127.0.0.1", self.port)
+
+    def forecast_body(self, exclude):
+        """Returns the JSON of the forecast fixture without the excluded blocks, encoded once per exclude list"""
+        body = self.bodies.get(exclude)
+        if body is None:
+            excluded = exclude.split(",")
+            body = json.dumps({block: value for block, value in self.forecast.items()
+                               if block not in excluded}).encode("utf-8")
+            self.bodies[exclude] = body
+        return body
+
+    def make_handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path.startswith("/forecast/"):
+                    exclude = parse_qs(url.query).get("exclude", [""])[0]
+                    self.reply(mock.forecast_body(exclude))
+                elif url.path == "/maps/api/geocode/json":
+                    self.reply(mock.geocode)
+                else:
+                    self.reply(b'{"code": 404, "error": "Not found"}', 404)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                url = urlsplit(self.path)
+                if url.path == "/geolocation/v1/geolocate":
+                    self.reply(mock.geolocate)
+                else:
+                    self.reply(b'{"code": 404, "error": "Not found"}', 404)
+
+            def reply(self, body, code=200):
+                mock.requests += 1
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                if "gzip" in self.headers.get("Accept-Encoding", ""):
+                    # Compress each distinct body once so the server adds little to timings
+                    if body not in mock.compressed:
+                        mock.compressed[body] = gzip.compress(body)
+                    body = mock.compressed[body]
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
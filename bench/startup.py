@@ -0,0 +1,82 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+import argparse, json, os, subprocess, sys, time
+
+"""
+Cold-start benchmark for rain.py
+
+Runs rain.py several times under `python3 -X importtime` and reports the
+median wall time and the modules whose imports cost the most. Arguments
+after -- are passed to rain.py (default: -h)
+
+    python3 bench/startup.py -n 20
+    python3 bench/startup.py --json -- -c --via-daemon
+"""
+
+RAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rain.py")
+
+
+def parse_importtime(stderr):
+    """Returns {module: cumulative microseconds} for the top-level imports in -X importtime output"""
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented under the module that triggered them
+        if not name[1:].startswith(" "):
+            imports[name.strip()] = int(cumulative)
+    return imports
+
+
+def run(rain_args, runs):
+    """Returns (wall times in seconds, [{module: microseconds}]) for runs executions of rain.py"""
+    walls, imports = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime", RAIN] + rain_args,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        walls.append(time.perf_counter() - start)
+        imports.append(parse_importtime(result.stderr))
+    return walls, imports
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+def summarize(rain_args, walls, imports, top):
+    modules = set().union(*imports)
+    costs = {module: median([run.get(module, 0) for run in imports]) for module in modules}
+    return {
+        "args": rain_args,
+        "runs": len(walls),
+        "wall_median_ms": round(median(walls) * 1000, 2),
+        "wall_min_ms": round(min(walls) * 1000, 2),
+        "imports_ms": round(median([sum(run.values()) for run in imports]) / 1000, 2),
+        "slowest_imports_ms": {module: round(cost / 1000, 2) for module, cost in
+                               sorted(costs.items(), key=lambda item: item[1], reverse=True)[:top]},
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure rain.py cold-start time")
+    parser.add_argument("-n", "--runs", help="Number of runs (default: 10)", type=int, default=10)
+    parser.add_argument("--top", help="Number of slowest imports to list (default: 10)", type=int, default=10)
+    parser.add_argument("--json", help="Print results as JSON", action="store_true")
+    parser.add_argument("rain_args", nargs=argparse.REMAINDER, help="Arguments for rain.py, after --")
+    args = parser.parse_args()
+    rain_args = [arg for arg in args.rain_args if arg != "--"] or ["-h"]
+
+    walls, imports = run(rain_args, args.runs)
+    summary = summarize(rain_args, walls, imports, args.top)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print("rain.py %s: %s runs" % (" ".join(rain_args), summary["runs"]))
+        print("Wall time: %s ms median, %s ms min" % (summary["wall_median_ms"], summary["wall_min_ms"]))
+        print("Top-level imports: %s ms" % summary["imports_ms"])
+        for module, cost in summary["slowest_imports_ms"].items():
+            print("  %8.2f ms  %s" % (cost, module))
@@ -0,0 +1,196 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+import argparse, contextlib, io, json, os, platform, sys, tempfile, time
+
+"""
+Offline benchmark suite for rain
+
+Replays the sample API responses in bench/fixtures through a local stand-in
+server (bench/mockserver.py) and times each CLI mode and each phase of a
+forecast (config parsing, fetching, JSON decoding, unit conversion, the
+typed model, analytics, rendering) separately. Needs no API key or network.
+
+    python3 bench/suite.py -n 20 --output before.json
+    python3 bench/suite.py -n 20 --compare before.json
+"""
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+RAIN = os.path.join(ROOT, "rain.py")
+sys.path[:0] = [ROOT, BENCH]
+
+import config, mockserver, rain, transport, units as unit_systems
+from analytics import summarize
+from model import ForecastModel
+
+COORDINATES = "42.3601, -71.0589"
+ADDRESS = "1 City Hall Sq Boston MA"
+
+# CLI modes timed end to end: name -> rain.py arguments
+CLI_MODES = {
+    "cli_currently": ["-c"],
+    "cli_day": ["-d", "0", "1", "2"],
+    "cli_weekly": ["-w"],
+    "cli_hourly": ["-o"],
+    "cli_minutely": ["-m"],
+}
+
+
+def measure(func, runs):
+    """Calls func runs times (after one warm-up call) and returns timing stats in milliseconds"""
+    func()
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {"runs": runs, "median_ms": round(times[len(times) // 2], 4), "min_ms": round(times[0], 4)}
+
+
+@contextlib.contextmanager
+def sandbox():
+    """Points rain at a throwaway rain.conf and cache directory"""
+    saved_conf, saved_cache = config.CONF_PATH, os.environ.get("XDG_CACHE_HOME")
+    with tempfile.TemporaryDirectory() as tmp:
+        conf_path = os.path.join(tmp, "rain.conf")
+        settings = config.ParseConfig(conf_path)
+        settings.generate_conf()
+        settings.write_settings({"coordinates": COORDINATES, "darksky_key": "bench", "maps_key": "bench",
+                                 "address": ADDRESS, "mac": "02:00:00:00:00:01", "units": "auto"})
+        config.CONF_PATH = conf_path
+        os.environ["XDG_CACHE_HOME"] = os.path.join(tmp, "cache")
+        try:
+            yield tmp
+        finally:
+            config.CONF_PATH = saved_conf
+            if saved_cache is None:
+                os.environ.pop("XDG_CACHE_HOME", None)
+            else:
+                os.environ["XDG_CACHE_HOME"] = saved_cache
+
+
+with open(RAIN, "r", encoding="utf-8") as rain_file:
+    # Compiled once so CLI timings don't include compiling rain.py
+    RAIN_CODE = compile(rain_file.read(), RAIN, "exec")
+
+
+def run_cli(args):
+    """Runs rain.py's command line in-process with its output discarded"""
+    saved_argv = sys.argv
+    sys.argv = ["rain.py"] + args
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            exec(RAIN_CODE, {"__name__": "__main__", "__file__": RAIN})
+    finally:
+        sys.argv = saved_argv
+
+
+def bench_cli(results, runs):
+    for name, args in CLI_MODES.items():
+        results[name] = measure(lambda: run_cli(args + ["--no-cache"]), runs)
+    results["cli_currently_cached"] = measure(lambda: run_cli(["-c"]), runs)
+
+
+def bench_phases(results, runs, tmp):
+    with open(os.path.join(mockserver.FIXTURES, "darksky_forecast.json"), "r", encoding="utf-8") as fixture:
+        text = fixture.read()
+
+    def parse_config():
+        config._snapshots.clear()
+        config.ParseConfig().snapshot()
+    results["config_parse"] = measure(parse_config, runs)
+    results["config_read_setting"] = measure(lambda: config.ParseConfig().read_setting("units"), runs)
+
+    results["fetch_forecast"] = measure(
+        lambda: rain.Forecast().get_weather(COORDINATES, "all", use_cache=False), runs)
+
+    geocode_store = os.path.join(tmp, "cache", "rain", "geocode.store")
+    def geocode():
+        if os.path.exists(geocode_store):
+            os.remove(geocode_store)
+        rain.Locator().goog_geocode(ADDRESS)
+    def geolocate():
+        if os.path.exists(geocode_store):
+            os.remove(geocode_store)
+        rain.Locator().goog_geolocate("02:00:00:00:00:01")
+    results["geocode"] = measure(geocode, runs)
+    results["geolocate"] = measure(geolocate, runs)
+
+    results["json_decode"] = measure(lambda: json.loads(text), runs)
+    decoded = [json.loads(text) for _ in range(runs + 1)]
+    results["units_convert"] = measure(lambda: unit_systems.convert_response(decoded.pop(), "us"), runs)
+    response = json.loads(text)
+    # The model takes blocks out of the response it is given, so each run gets its own
+    results["model_hourly"] = measure(lambda: ForecastModel(dict(response)).hourly, runs)
+    series = ForecastModel(dict(response)).hourly
+    results["analytics_hourly"] = measure(lambda: summarize(series, 25), runs)
+
+    forecast = rain.Forecast()
+    forecast.get_weather(COORDINATES, "all")
+    forecast.get_currently()
+    forecast.get_minutely()
+    forecast.includes = ["currently", "minutely"]
+    forecast.get_alerts()
+    def render(method, *args):
+        with contextlib.redirect_stdout(io.StringIO()):
+            method(*args)
+    results["render_currently"] = measure(lambda: render(forecast.print_currently), runs)
+    results["render_daily"] = measure(lambda: [render(forecast.print_daily, day) for day in range(5)], runs)
+    results["render_alerts"] = measure(lambda: render(forecast.print_alert), runs)
+
+
+def compare(results, baseline, tolerance):
+    """Prints median changes against a baseline run. Returns the names that regressed beyond tolerance"""
+    regressions = []
+    print("%-24s %12s %12s %8s" % ("benchmark", "baseline ms", "current ms", "change"))
+    for name, result in results.items():
+        before = baseline.get("results", {}).get(name)
+        if not before:
+            print("%-24s %12s %12.3f" % (name, "-", result["median_ms"]))
+            continue
+        change = result["median_ms"] / before["median_ms"] - 1 if before["median_ms"] else 0
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("%-24s %12.3f %12.3f %+7.1f%%%s" % (name, before["median_ms"], result["median_ms"], change * 100, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time rain against sample API responses")
+    parser.add_argument("-n", "--runs", help="Runs per benchmark (default: 10)", type=int, default=10)
+    parser.add_argument("--alerts", help="Serve the alert-heavy fixture", action="store_true")
+    parser.add_argument("--output", help="Write results as JSON to FILE", metavar="FILE")
+    parser.add_argument("--compare", help="Compare against results previously written with --output", metavar="FILE")
+    parser.add_argument("--tolerance", help="Slowdown that counts as a regression (default: 0.25)",
+                        type=float, default=0.25)
+    args = parser.parse_args()
+
+    server = mockserver.MockServer(alerts=args.alerts).start()
+    server.route(transport.default_pool)
+    results = {}
+    try:
+        with sandbox() as tmp:
+            bench_cli(results, args.runs)
+            bench_phases(results, args.runs, tmp)
+    finally:
+        server.stop()
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "fixture": "alerts" if args.alerts else "forecast",
+        "results": results,
+        "transport": transport.default_pool.stats,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        sys.exit(1 if regressions else 0)
+    elif not args.output:
+        print(json.dumps(report, indent=2))
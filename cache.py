@@ -0,0 +1,162 @@
+import hashlib, json, os, threading, time
+
+# Seconds each data block stays fresh. A cached response is only as fresh
+# as the shortest-lived block it was requested for
+BLOCK_TTL = {
+    "currently": 5 * 60,
+    "minutely": 5 * 60,
+    "alerts": 15 * 60,
+    "hourly": 30 * 60,
+    "daily": 3 * 60 * 60,
+    "flags": 24 * 60 * 60,
+}
+# Number of responses kept on disk before the oldest are evicted
+MAX_ENTRIES = 64
+# Seconds a geocoded address or a geolocated MAC address stays valid
+GEOCODE_TTL = {
+    "address": 30 * 24 * 60 * 60,
+    "mac": 24 * 60 * 60,
+}
+
+
+def default_cache_dir():
+    """Returns $XDG_CACHE_HOME/rain, falling back to ~/.cache/rain"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "rain")
+
+
+def normalize_address(address):
+    """Lowercases address and drops punctuation so different spellings of it share a key"""
+    address = address.replace("+", " ").lower()
+    return " ".join("".join(c if c.isalnum() else " " for c in address).split())
+
+
+def snap_coordinates(coordinates, grid):
+    """
+    Rounds coordinates, a tuple or a "lat, lon" string, to the nearest
+    multiple of grid degrees. Returns a "lat,lon" string
+    """
+    if isinstance(coordinates, str):
+        coordinates = coordinates.split(",")
+    lat, lon = (float(value) for value in coordinates)
+    if grid:
+        lat = round(round(lat / grid) * grid, 6)
+        lon = round(round(lon / grid) * grid, 6)
+    return "%s,%s" % (lat, lon)
+
+
+class ResponseCache(object):
+    """
+    On-disk cache of raw API responses, one file per request key
+    The file's mtime is the time the response was fetched
+    """
+    def __init__(self, cache_dir=None, max_entries=MAX_ENTRIES):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_entries = max_entries
+
+    def make_key(self, *parts):
+        """Returns a filename-safe key for the given request parameters"""
+        key = "|".join(map(str, parts))
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def ttl(self, blocks):
+        """Returns the freshness lifetime in seconds of a response containing blocks"""
+        ttls = [BLOCK_TTL[block] for block in blocks if block in BLOCK_TTL]
+        if not ttls:
+            return min(BLOCK_TTL.values())
+        return min(ttls)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key, max_age):
+        """Returns the cached response for key if younger than max_age seconds, otherwise None"""
+        path = self.path(key)
+        try:
+            age = time.time() - os.stat(path).st_mtime
+            if age > max_age:
+                return None
+            with open(path, "r", encoding="utf-8") as cache_file:
+                return cache_file.read()
+        except OSError:
+            return None
+
+    def age(self, key):
+        """Returns how many seconds ago the response for key was fetched, or None if it isn't cached"""
+        try:
+            return time.time() - os.stat(self.path(key)).st_mtime
+        except OSError:
+            return None
+
+    def put(self, key, response):
+        """Stores response under key, then evicts the oldest entries over max_entries"""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Write to a temp file and rename so readers never see a partial response
+            import tempfile
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as cache_file:
+                cache_file.write(response)
+            os.replace(tmp_path, self.path(key))
+        except OSError:
+            # An unwritable cache must never break a forecast
+            return
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently fetched responses beyond max_entries"""
+        try:
+            entries = [os.path.join(self.cache_dir, name)
+                       for name in os.listdir(self.cache_dir) if name.endswith(".json")]
+            entries.sort(key=lambda entry: os.stat(entry).st_mtime, reverse=True)
+            for entry in entries[self.max_entries:]:
+                os.remove(entry)
+        except OSError:
+            pass
+
+
+class GeocodeCache(object):
+    """
+    Coordinates previously returned by the geocoding and geolocation APIs,
+    keyed by normalized address or MAC address, stored in one JSON file
+    """
+    lock = threading.Lock()
+
+    def __init__(self, cache_dir=None):
+        self.path = os.path.join(cache_dir or default_cache_dir(), "geocode.store")
+
+    def make_key(self, kind, value):
+        if kind == "address":
+            return "address:" + normalize_address(value)
+        return "%s:%s" % (kind, value.strip().lower())
+
+    def get(self, kind, value):
+        """Returns (lat, lon) for value if looked up within GEOCODE_TTL[kind], otherwise None"""
+        entry = self._load().get(self.make_key(kind, value))
+        if entry and time.time() - entry["time"] <= GEOCODE_TTL[kind]:
+            return entry["lat"], entry["lon"]
+        return None
+
+    def put(self, kind, value, coordinates):
+        """Stores (lat, lon) for value, dropping expired entries"""
+        now = time.time()
+        ttl = max(GEOCODE_TTL.values())
+        with self.lock:
+            entries = {key: entry for key, entry in self._load().items() if now - entry["time"] <= ttl}
+            entries[self.make_key(kind, value)] = {"lat": coordinates[0], "lon": coordinates[1], "time": now}
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                import tempfile
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".tmp")
+                with os.fdopen(fd, "w", encoding="utf-8") as cache_file:
+                    json.dump(entries, cache_file)
+                os.replace(tmp_path, self.path)
+            except OSError:
+                pass
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
@@ -0,0 +1,166 @@
+import json, os, threading
+
+from cache import ResponseCache, default_cache_dir
+
+"""
+Structural differences between successive forecasts for a location
+
+A ChangeTracker keeps the last reported forecast per location (its current
+conditions, alerts and daily highs and lows, in SI) and diff() compares a
+new forecast with it. Changes smaller than the thresholds below don't count,
+and the stored forecast is only replaced when a change is reported, so slow
+drifts add up until they matter
+"""
+
+# Change in SI units past which a field of currently counts as changed; 0 means any change
+CURRENTLY_THRESHOLDS = {
+    "summary": 0,
+    "icon": 0,
+    "precipType": 0,
+    "temperature": 1.0,
+    "apparentTemperature": 2.0,
+    "precipProbability": 0.2,
+    "precipIntensity": 1.0,
+    "windSpeed": 3.0,
+    "windGust": 5.0,
+    "cloudCover": 0.3,
+    "visibility": 5.0,
+}
+# Shift in degrees C of a day's high or low that counts as a change
+DAILY_THRESHOLD = 2.0
+DAILY_FIELDS = ("temperatureMax", "temperatureMin")
+# Blocks of a response the tracker keeps
+TRACKED_BLOCKS = ("currently", "alerts", "daily")
+# Blocks compared only when both forecasts have them, since a run may not fetch them.
+# Alerts are fetched with every forecast and left out when there are none
+OPTIONAL_BLOCKS = ("currently", "daily")
+
+
+def alert_key(alert):
+    """Returns what identifies an alert between responses"""
+    return alert.get("uri") or "%s|%s" % (alert.get("title"), alert.get("time"))
+
+
+def diff(old, new, thresholds=CURRENTLY_THRESHOLDS, daily_threshold=DAILY_THRESHOLD):
+    """
+    Returns the meaningful changes from SI response old to SI response new
+    as a list of dicts with keys block ("currently", "alerts" or "daily"),
+    field, time, old and new. New alerts have an old value of None, expired
+    ones a new value of None. With no earlier response (old is None) nothing
+    counts as changed, and current conditions and daily forecasts are only
+    compared when both responses have them
+    """
+    if old is None:
+        return []
+    changes = []
+    before, after = old.get("currently"), new.get("currently")
+    if before is not None and after is not None:
+        for field, threshold in thresholds.items():
+            value = after.get(field)
+            previous = before.get(field)
+            if value == previous:
+                continue
+            if threshold and value is not None and previous is not None and abs(value - previous) < threshold:
+                continue
+            changes.append({"block": "currently", "field": field, "time": after.get("time"),
+                            "old": previous, "new": value})
+
+    before = {alert_key(alert): alert for alert in old.get("alerts") or []}
+    after = {alert_key(alert): alert for alert in new.get("alerts") or []}
+    for key, alert in after.items():
+        if key not in before:
+            changes.append({"block": "alerts", "field": "title", "time": alert.get("time"),
+                            "old": None, "new": alert.get("title")})
+    for key, alert in before.items():
+        if key not in after:
+            changes.append({"block": "alerts", "field": "title", "time": alert.get("time"),
+                            "old": alert.get("title"), "new": None})
+
+    # Days are matched by date, since the daily block moves on by a day at midnight
+    before = {day.get("time"): day for day in (old.get("daily") or {}).get("data", [])}
+    for day in (new.get("daily") or {}).get("data", []):
+        previous = before.get(day.get("time"))
+        if previous is None:
+            continue
+        for field in DAILY_FIELDS:
+            value, earlier = day.get(field), previous.get(field)
+            if value is not None and earlier is not None and abs(value - earlier) >= daily_threshold:
+                changes.append({"block": "daily", "field": field, "time": day.get("time"),
+                                "old": earlier, "new": value})
+    return changes
+
+
+def convert_changes(changes, units):
+    """Converts the values of SI changes to a resolved unit system in place"""
+    import units as unit_systems
+    factors = unit_systems.factors(units)
+    for change in changes:
+        if change["field"] in factors:
+            scale, offset = factors[change["field"]]
+            for side in ("old", "new"):
+                if change[side] is not None:
+                    change[side] = change[side] * scale + offset
+    return changes
+
+
+class ChangeTracker(object):
+    """The last reported forecast per location, one JSON file each under cache_dir/previous"""
+    lock = threading.Lock()
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = os.path.join(cache_dir or default_cache_dir(), "previous")
+
+    def path(self, location):
+        return os.path.join(self.cache_dir, ResponseCache().make_key(location) + ".json")
+
+    def get(self, location):
+        """Returns the last reported SI forecast blocks for location, or None"""
+        try:
+            with open(self.path(location), "r", encoding="utf-8") as previous:
+                return json.load(previous)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, location, response, previous=None):
+        """
+        Stores the tracked blocks of SI response as the last reported forecast
+        for location. Blocks response lacks are kept from previous, the
+        forecast stored until now
+        """
+        tracked = {block: previous[block] for block in OPTIONAL_BLOCKS if previous and block in previous}
+        tracked.update((block, response[block]) for block in OPTIONAL_BLOCKS if block in response)
+        tracked["alerts"] = response.get("alerts", [])
+        with self.lock:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp_path = "%s.%d.tmp" % (self.path(location), os.getpid())
+                with open(tmp_path, "w", encoding="utf-8") as previous:
+                    json.dump(tracked, previous)
+                os.replace(tmp_path, self.path(location))
+            except OSError:
+                pass
+
+    def update(self, location, response, **thresholds):
+        """
+        Returns diff() of the last reported forecast for location and SI
+        response, and makes response the last reported one if anything changed.
+        The first forecast seen for a location, and the first of each block, becomes
+        its baseline, with no changes
+        """
+        previous = self.get(location)
+        changes = diff(previous, response, **thresholds)
+        if changes or previous is None or any(block in response and block not in previous
+                                              for block in OPTIONAL_BLOCKS):
+            self.put(location, response, previous)
+        return changes
+
+
+def run_hook(command, location, units, changes):
+    """
+    Runs the shell command with the changes as JSON on stdin and the
+    location in $RAIN_LOCATION. Returns the command's exit status
+    """
+    import subprocess
+    env = dict(os.environ, RAIN_LOCATION=location)
+    document = json.dumps({"location": location, "units": units, "changes": changes})
+    return subprocess.run(command, shell=True, input=document.encode("utf-8"), env=env).returncode
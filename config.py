@@ -1,38 +1,142 @@
-import configparser, os, sys
+import contextlib, os, sys, threading
+from types import MappingProxyType
+
+import timing
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no flock; writes are still atomic, just not serialized
+    fcntl = None
+
+# Path of rain.conf, alongside config.py
+CONF_PATH = os.path.join(os.path.dirname(__file__), "rain.conf")
+
+# Parsed settings shared by every ParseConfig in the process,
+# keyed by path: ((mtime, size), read-only settings mapping)
+_snapshots = {}
+# Settings written inside ParseConfig.batch(), flushed in one write when the outermost batch exits
+_pending = {}
+_batch_depth = 0
+_lock = threading.RLock()
+_missing = object()
 
 class ParseConfig(object):
-    def read_setting(self, key):
-        """Returns setting of a given key in rain.conf"""
-        config = configparser.RawConfigParser(allow_no_value=True)
-        # Get path of config.py to read rain.conf
-        conf_path = os.path.dirname(__file__)
-        conf_path = os.path.join(conf_path, "rain.conf")
-        # TODO: Try/except
-        with open(conf_path, "r") as conf_file:
-            config.read(conf_path)
-            setting = config.get("Settings", key)
-            conf_file.close()
-            return setting
+    def __init__(self, conf_path=None):
+        self.conf_path = conf_path or CONF_PATH
+
+    def snapshot(self):
+        """
+        Returns a read-only mapping of the settings in rain.conf
+        The file is only parsed again when its mtime or size changes
+        """
+        stat = os.stat(self.conf_path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with _lock:
+            cached = _snapshots.get(self.conf_path)
+            if cached and cached[0] == stamp:
+                return cached[1]
+            with timing.span("config.parse"):
+                import configparser
+                config = configparser.RawConfigParser(allow_no_value=True)
+                config.read(self.conf_path)
+                settings = MappingProxyType(dict(config.items("Settings")))
+            timing.count("config.parses")
+            _snapshots[self.conf_path] = (stamp, settings)
+            return settings
+
+    def read_setting(self, key, default=_missing):
+        """
+        Returns setting of a given key in rain.conf
+        Raises configparser.NoOptionError if key is not set and no default is given
+        """
+        # configparser stores keys lowercased
+        key = key.lower()
+        with _lock:
+            if key in _pending:
+                return _pending[key]
+        settings = self.snapshot()
+        if key in settings:
+            return settings[key]
+        if default is _missing:
+            import configparser
+            raise configparser.NoOptionError(key, "Settings")
+        return default
 
     def write_setting(self, key, value):
         """ 
         Modify a setting in rain.conf by supplying
         key (setting), and the desired value
+        Inside batch(), the write is deferred until the batch exits
         """
-        config = configparser.RawConfigParser(allow_no_value=True)
-        conf_path = os.path.dirname(__file__)
-        conf_path = os.path.join(conf_path, "rain.conf")
-        config.read(conf_path)
-        config.set("Settings", key, value)
-        with open(conf_path, "w") as conf_file:
-            config.write(conf_file)
-            conf_file.close()
+        with _lock:
+            if _batch_depth:
+                _pending[key.lower()] = value
+                return
+        self.write_settings({key: value})
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Collects write_setting calls and writes them to rain.conf at once"""
+        global _batch_depth
+        with _lock:
+            _batch_depth += 1
+        try:
+            yield self
+        finally:
+            with _lock:
+                _batch_depth -= 1
+                updates = dict(_pending) if not _batch_depth else {}
+                if not _batch_depth:
+                    _pending.clear()
+            if updates:
+                self.write_settings(updates)
+
+    def write_settings(self, settings):
+        """Modify several settings in rain.conf with a single atomic write"""
+        with _lock, self._file_lock(), timing.span("config.write"):
+            # Re-read under the lock so concurrent writers don't drop each other's settings
+            import configparser
+            config = configparser.RawConfigParser(allow_no_value=True)
+            config.read(self.conf_path)
+            for key, value in settings.items():
+                config.set("Settings", key, value)
+            self._replace(config)
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        """Holds an exclusive lock on rain.conf.lock while rain.conf is rewritten"""
+        if fcntl is None:
+            yield
+            return
+        with open(self.conf_path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _replace(self, config):
+        """Writes config to a temp file beside rain.conf and renames it into place"""
+        import tempfile
+        conf_dir = os.path.dirname(os.path.abspath(self.conf_path))
+        fd, tmp_path = tempfile.mkstemp(dir=conf_dir, prefix=".rain.conf.")
+        try:
+            with os.fdopen(fd, "w") as conf_file:
+                config.write(conf_file)
+            # mkstemp creates the file 0600, keep the permissions rain.conf already had
+            if os.path.exists(self.conf_path):
+                os.chmod(tmp_path, os.stat(self.conf_path).st_mode & 0o777)
+            os.replace(tmp_path, self.conf_path)
+        except:
+            os.remove(tmp_path)
+            raise
+        _snapshots.pop(self.conf_path, None)
 
     def generate_conf(self):
         """Generates the default configuration file rain.conf"""
+        import configparser
         config = configparser.RawConfigParser(allow_no_value=True)
-        conf_path = os.path.dirname(__file__)
-        conf_path = os.path.join(conf_path, "rain.conf")
         config.optionxform = str
         config.add_section("Settings")
         config.set("Settings", "# Your location in geocoordinates latitude and longitude")
@@ -48,10 +152,24 @@ class ParseConfig(object):
         config.set("Settings", "# Enable the Google Maps Geolocation API and Google Maps Geocoding API")
         config.set("Settings", "maps_key", "")
         config.set("Settings", "")
+        config.set("Settings", "# Forecast providers, asked in order: darksky, or file:PATH for a recorded response.")
+        config.set("Settings", "# With more than one, the next is also asked when one fails or is slower than")
+        config.set("Settings", "# hedge_percentile of its recent requests (hedge_delay seconds until it has a history)")
+        config.set("Settings", "providers", "darksky")
+        config.set("Settings", "hedge_percentile", "95")
+        config.set("Settings", "hedge_delay", "1.0")
+        config.set("Settings", "")
+        config.set("Settings", "# Geocoding provider for your address and MAC address: google, or file:PATH")
+        config.set("Settings", "geocoder", "google")
+        config.set("Settings", "")
         config.set("Settings", "# Units of measurement. 'Auto' is the default.")
         config.set("Settings", "# Units: auto, ca, uk2, us, si")
         config.set("Settings", "units", "auto")
         config.set("Settings", "")
+        config.set("Settings", "# Round coordinates to a grid of this many degrees before fetching a forecast,")
+        config.set("Settings", "# so nearby locations share one request. Leave blank to use exact coordinates")
+        config.set("Settings", "grid", "")
+        config.set("Settings", "")
         config.set("Settings", "# Your residental (home) address. Used in case geolocation by mac or IP fails.")
         config.set("Settings", "# Enter address with no punctuation.")
         config.set("Settings", "address", "")
@@ -63,7 +181,17 @@ class ParseConfig(object):
         config.set("Settings", "# 'yes' disables parsing of coordinates and address from this config")
         config.set("Settings", "# when Locator() is called from rain-server")
         config.set("Settings", "server", "no")
+        config.set("Settings", "")
+        config.set("Settings", "# Seconds a rain command may spend on network requests before showing the last")
+        config.set("Settings", "# cached forecast or giving up. Leave blank for no limit")
+        config.set("Settings", "deadline", "30")
+        config.set("Settings", "")
+        config.set("Settings", "# Shell command run by rain.py --changes-only when the forecast changes,")
+        config.set("Settings", "# with the changes as JSON on stdin and the location in $RAIN_LOCATION")
+        config.set("Settings", "change_hook", "")
+        config.set("Settings", "")
+        config.set("Settings", "# Dark Sky API calls the rain daemon (rain.py --serve) may make per day")
+        config.set("Settings", "daily_budget", "1000")
 
-        with open(conf_path, "w") as conf_file:
-            config.write(conf_file)
-            conf_file.close()
\ No newline at end of file
+        with _lock, self._file_lock():
+            self._replace(config)
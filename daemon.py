@@ -0,0 +1,161 @@
+import json, threading
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import transport, units as unit_systems
+from cache import snap_coordinates
+from scheduler import DAILY_BUDGET, OverBudget, RefreshScheduler
+
+"""
+rain daemon: keeps forecasts in memory and serves them as JSON over HTTP
+
+Endpoints, all taking optional ?location=lat,lon and ?units=auto|ca|uk2|us|si:
+    /currently      current conditions
+    /minutely       minute-by-minute block
+    /hourly         hourly block
+    /daily          list of daily forecasts, /daily/<n> for one day
+    /alerts         list of weather alerts
+    /forecast       the whole response
+"""
+
+# Block whose freshness each endpoint needs; /forecast is treated like /currently
+ENDPOINT_BLOCKS = {"currently": "currently", "minutely": "minutely", "hourly": "hourly",
+                   "daily": "daily", "alerts": "alerts", "forecast": "currently"}
+
+
+def parse_address(address):
+    """Returns (host, port) from "host:port", ":port" or "port" """
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+class ForecastStore(object):
+    """
+    SI forecasts held in memory per location, as the JSON text Dark Sky sent,
+    and refreshed through a scheduler.RefreshScheduler. Each endpoint's JSON
+    in each unit system is built on its first request after a refresh, and
+    only the encoded bodies are kept
+    """
+    def __init__(self, forecast_class, budget=DAILY_BUDGET, min_interval=0):
+        self.forecast_class = forecast_class
+        self.scheduler = RefreshScheduler(self.fetch, budget, min_interval)
+
+    def get(self, location, path):
+        """Returns the entry for location, which may be refreshing in the background"""
+        block = ENDPOINT_BLOCKS.get(path.strip("/").split("/")[0])
+        if block is None:
+            raise KeyError(path)
+        return self.scheduler.get(location, block)
+
+    def fetch(self, location):
+        """Fetches a fresh SI forecast for location. Called by the scheduler"""
+        forecast = self.forecast_class()
+        # The scheduler decides freshness, so skip the on-disk cache
+        forecast.get_weather(location, "all", use_cache=False, units="si")
+        if "error" in forecast.response:
+            raise LookupError("%s - %s" % (forecast.response.get('code'), forecast.response['error']))
+        return {"text": forecast.text, "encoded": {}, "lock": threading.Lock()}
+
+    def encoded(self, entry, units, path):
+        """Returns the JSON body for path in units, building it on first use"""
+        body = entry["encoded"].get((units, path))
+        if body is None:
+            with entry["lock"]:
+                body = entry["encoded"].get((units, path))
+                if body is None:
+                    # Decoded for this body alone, so no dicts outlive the request
+                    response = json.loads(entry["text"])
+                    unit_systems.convert_response(response, units)
+                    body = json.dumps(self.select(response, path)).encode("utf-8")
+                    entry["encoded"][(units, path)] = body
+        return body
+
+    def select(self, response, path):
+        """Returns the part of response an endpoint path serves. Raises KeyError for unknown paths"""
+        parts = path.strip("/").split("/")
+        if parts == ["forecast"]:
+            return response
+        elif parts == ["alerts"]:
+            return response.get("alerts", [])
+        elif parts[0] == "daily" and len(parts) == 2:
+            try:
+                return response["daily"]["data"][int(parts[1])]
+            except (ValueError, IndexError):
+                raise KeyError(path)
+        elif parts[0] == "daily" and len(parts) == 1:
+            return response["daily"]["data"]
+        elif len(parts) == 1 and parts[0] in ("currently", "minutely", "hourly"):
+            return response[parts[0]]
+        raise KeyError(path)
+
+
+def make_handler(store, default_location, default_units, grid=0):
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body go out in separate writes; don't let Nagle hold the body back
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            units = query.get("units", [default_units])[0]
+            try:
+                # Nearby and differently spelled coordinates share one entry and one upstream call
+                location = snap_coordinates(query.get("location", [default_location])[0], grid)
+                entry = store.get(location, url.path)
+                body = store.encoded(entry, units, url.path)
+                self.reply(200, body)
+            except OverBudget as err:
+                self.error(503, str(err))
+            except KeyError:
+                self.error(404, "Unknown endpoint %s" % url.path)
+            except ValueError as err:
+                self.error(400, str(err))
+            except Exception as err:
+                self.error(502, str(err))
+
+        def error(self, code, message):
+            # Same shape as Dark Sky's error responses
+            self.reply(code, json.dumps({"code": code, "error": message}).encode("utf-8"))
+
+        def reply(self, code, body):
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(forecast_class, address, location, units, budget=DAILY_BUDGET, min_interval=0, grid=0):
+    """
+    Runs the daemon on address until interrupted. location and units are used
+    for requests that don't name their own. budget caps upstream calls per day,
+    min_interval is the shortest time in seconds between refreshes of a location
+    and requested locations are snapped to a grid of grid degrees
+    """
+    from http.server import ThreadingHTTPServer
+
+    store = ForecastStore(forecast_class, budget, min_interval)
+    server = ThreadingHTTPServer(parse_address(address), make_handler(store, location, units, grid))
+    server.daemon_threads = True
+    print("rain daemon listening on %s:%s" % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def fetch(address, location, units="si"):
+    """Returns the raw JSON text of the whole forecast for location from a running daemon"""
+    host, port = parse_address(address)
+    request_path = "/forecast?" + urlencode({"location": location, "units": units})
+    response = transport.default_pool.request('GET', "%s:%s" % (host, port), request_path, scheme="http")
+    return response.text
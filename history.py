@@ -0,0 +1,233 @@
+import os, sqlite3, time
+from datetime import date, datetime, timedelta
+
+import units as unit_systems
+
+"""
+Local store of historical observations fetched with Dark Sky time-machine requests
+
+Hourly and daily data points are kept in SI in a SQLite database, one row per
+location and hour or day. Both tables are clustered on (location, time) so a
+date range for a location is read with one index range scan. Each fetched
+location-day is recorded in the same transaction as its data, so an
+interrupted backfill resumes where it stopped
+"""
+
+# Fields stored per hourly and daily data point, by their Dark Sky names
+HOURLY_FIELDS = ("temperature", "apparentTemperature", "dewPoint", "humidity", "pressure",
+                 "windSpeed", "windGust", "windBearing", "cloudCover", "visibility",
+                 "precipIntensity", "precipProbability", "precipType", "summary", "icon")
+DAILY_FIELDS = ("temperatureMax", "temperatureMaxTime", "temperatureMin", "temperatureMinTime",
+                "dewPoint", "humidity", "pressure", "windSpeed", "windGust", "windBearing",
+                "cloudCover", "precipIntensityMax", "precipProbability", "precipAccumulation",
+                "precipType", "sunriseTime", "sunsetTime", "moonPhase", "summary", "icon")
+TEXT_FIELDS = ("precipType", "summary", "icon")
+
+# strftime() pattern naming the period each hour is aggregated into
+PERIODS = {"hour": "%Y-%m-%d %H:00", "day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}
+# Columns of aggregate() rows, and the quantity (see units.QUANTITIES) of those that have units
+AGGREGATE_COLUMNS = ("period", "hours", "temperatureMin", "temperatureMean", "temperatureMax",
+                     "precipTotal", "rainHours", "windGustMax")
+AGGREGATE_QUANTITIES = {"temperatureMin": "temperature", "temperatureMean": "temperature",
+                        "temperatureMax": "temperature", "precipTotal": "intensity",
+                        "windGustMax": "speed"}
+# Hours with at least this chance of rain count as rain hours
+RAIN_PROBABILITY = 0.5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS locations (
+    id INTEGER PRIMARY KEY,
+    location TEXT NOT NULL UNIQUE,
+    timezone TEXT,
+    utc_offset REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS hourly (
+    location_id INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    %s,
+    PRIMARY KEY (location_id, time)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS daily (
+    location_id INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    %s,
+    PRIMARY KEY (location_id, time)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS progress (
+    location_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    fetched INTEGER NOT NULL,
+    PRIMARY KEY (location_id, day)
+) WITHOUT ROWID;
+""" % tuple(",\n    ".join('"%s" %s' % (field, "TEXT" if field in TEXT_FIELDS else "REAL") for field in fields)
+            for fields in (HOURLY_FIELDS, DAILY_FIELDS))
+
+
+def default_store_path():
+    """Returns $XDG_DATA_HOME/rain/history.db, falling back to ~/.local/share/rain/history.db"""
+    base = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(base, "rain", "history.db")
+
+
+def parse_date(value):
+    """Returns the date for a "YYYY-MM-DD" string. Raises ValueError for anything else"""
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def date_range(start, end):
+    """Returns the "YYYY-MM-DD" dates from start to end inclusive"""
+    start, end = parse_date(start), parse_date(end)
+    return [(start + timedelta(days=n)).isoformat() for n in range((end - start).days + 1)]
+
+
+def day_bounds(start, end, offset):
+    """
+    Returns the Unix times bounding local days start to end inclusive at a
+    UTC offset of offset hours. Dark Sky only reports a location's current
+    offset, so ranges spanning a daylight saving change are off by an hour at one end
+    """
+    epoch = date(1970, 1, 1)
+    low = (parse_date(start) - epoch).days * 86400 - int(offset * 3600)
+    high = ((parse_date(end) - epoch).days + 1) * 86400 - int(offset * 3600)
+    return low, high
+
+
+class HistoryStore(object):
+    """
+    SQLite store of SI hourly and daily observations per location
+    A store must only be used from the thread that opened it
+    """
+    def __init__(self, path=None):
+        self.path = path or default_store_path()
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.row_factory = sqlite3.Row
+        # Bulk ingestion commits once per day of data; WAL keeps those commits cheap
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def location(self, location, create=False):
+        """Returns the locations row for location, a "lat,lon" string, or None if it was never stored"""
+        row = self.db.execute("SELECT * FROM locations WHERE location = ?", (location,)).fetchone()
+        if row is None and create:
+            self.db.execute("INSERT INTO locations (location) VALUES (?)", (location,))
+            row = self.location(location)
+        return row
+
+    def stored_days(self, location):
+        """Returns the set of "YYYY-MM-DD" days already fetched for location"""
+        row = self.location(location)
+        if row is None:
+            return set()
+        return {day for day, in self.db.execute("SELECT day FROM progress WHERE location_id = ?", (row["id"],))}
+
+    def add(self, location, day, response):
+        """Stores the hourly and daily data of an SI time-machine response for location on day"""
+        with self.db:
+            location_id = self.location(location, create=True)["id"]
+            self.db.execute("UPDATE locations SET timezone = ?, utc_offset = ? WHERE id = ?",
+                            (response.get("timezone"), response.get("offset", 0), location_id))
+            for table, fields in (("hourly", HOURLY_FIELDS), ("daily", DAILY_FIELDS)):
+                points = response.get(table, {}).get("data", [])
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO %s (location_id, time, %s) VALUES (?, ?, %s)' % (
+                        table, ", ".join('"%s"' % field for field in fields), ", ".join("?" * len(fields))),
+                    [(location_id, point["time"]) + tuple(point.get(field) for field in fields)
+                     for point in points])
+            self.db.execute("INSERT OR REPLACE INTO progress (location_id, day, fetched) VALUES (?, ?, ?)",
+                            (location_id, day, int(time.time())))
+
+    def points(self, location, start, end, table="hourly"):
+        """Returns the stored hourly or daily data points for location from day start to end as dicts"""
+        row = self.location(location)
+        if row is None:
+            return []
+        low, high = day_bounds(start, end, row["utc_offset"])
+        cursor = self.db.execute("SELECT * FROM %s WHERE location_id = ? AND time >= ? AND time < ? ORDER BY time"
+                                 % ("daily" if table == "daily" else "hourly"), (row["id"], low, high))
+        return [{name: point[name] for name in point.keys() if name != "location_id" and point[name] is not None}
+                for point in cursor]
+
+    def aggregate(self, location, start, end, period="day"):
+        """
+        Returns one dict per period ("hour", "day", "month" or "year", in the
+        location's local time) from day start to end with the columns in
+        AGGREGATE_COLUMNS. precipTotal is in mm, the rest in SI
+        """
+        row = self.location(location)
+        if row is None:
+            return []
+        low, high = day_bounds(start, end, row["utc_offset"])
+        cursor = self.db.execute(
+            """SELECT strftime(?, time + ?, 'unixepoch') AS period, count(*) AS hours,
+                      min(temperature) AS temperatureMin, avg(temperature) AS temperatureMean,
+                      max(temperature) AS temperatureMax, total(precipIntensity) AS precipTotal,
+                      total(precipProbability >= ?) AS rainHours, max(windGust) AS windGustMax
+               FROM hourly WHERE location_id = ? AND time >= ? AND time < ?
+               GROUP BY 1 ORDER BY 1""",
+            (PERIODS[period], int(row["utc_offset"] * 3600), RAIN_PROBABILITY, row["id"], low, high))
+        return [dict(zip(AGGREGATE_COLUMNS, values)) for values in cursor]
+
+    def convert(self, location, rows, units):
+        """
+        Converts aggregate() rows to units in place; 'auto' is resolved from the
+        location's time zone. Returns the unit system used
+        """
+        row = self.location(location)
+        units = unit_systems.resolve(units, row["timezone"] if row else None)
+        conversions = unit_systems.CONVERSIONS[units]
+        for column, quantity in AGGREGATE_QUANTITIES.items():
+            if quantity in conversions:
+                scale, offset = conversions[quantity]
+                for aggregate in rows:
+                    if aggregate[column] is not None:
+                        aggregate[column] = aggregate[column] * scale + offset
+        return units
+
+
+def backfill(store, forecast_class, locations, start, end, concurrency=8, report=None):
+    """
+    Fetches every day from start to end ("YYYY-MM-DD", inclusive) for each
+    location with up to concurrency time-machine requests at once and stores
+    them. Days already in the store are skipped, so an interrupted backfill
+    can simply be run again. report(location, day, error) is called as each
+    day completes. Returns (fetched, skipped, failed) day counts
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    days = date_range(start, end)
+    tasks = []
+    skipped = 0
+    for location in locations:
+        stored = store.stored_days(location)
+        skipped += len(stored.intersection(days))
+        tasks.extend((location, day) for day in days if day not in stored)
+
+    def fetch(location, day):
+        return forecast_class().get_weather_at(location, day)
+
+    fetched = failed = 0
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    try:
+        futures = {executor.submit(fetch, location, day): (location, day) for location, day in tasks}
+        for future in as_completed(futures):
+            location, day = futures[future]
+            try:
+                # Only this thread writes to the store
+                store.add(location, day, future.result())
+                fetched += 1
+                error = None
+            except Exception as err:
+                failed += 1
+                error = err
+            if report:
+                report(location, day, error)
+    finally:
+        # When interrupted, drop the queued days; they are fetched on the next run
+        executor.shutdown(wait=True, cancel_futures=True)
+    return fetched, skipped, failed
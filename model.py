@@ -0,0 +1,192 @@
+from array import array
+
+"""
+Compact representations of Dark Sky data blocks
+Scalar blocks (currently, each day of daily) become DataPoint objects,
+series blocks (minutely, hourly) become array-backed Series columns
+"""
+
+# Data point fields documented by Dark Sky: https://darksky.net/dev/docs#data-point
+FIELDS = (
+    "time", "summary", "icon", "sunriseTime", "sunsetTime", "moonPhase",
+    "nearestStormDistance", "nearestStormBearing",
+    "precipIntensity", "precipIntensityError", "precipIntensityMax", "precipIntensityMaxTime",
+    "precipProbability", "precipType", "precipAccumulation",
+    "temperature", "apparentTemperature",
+    "temperatureHigh", "temperatureHighTime", "temperatureLow", "temperatureLowTime",
+    "apparentTemperatureHigh", "apparentTemperatureHighTime",
+    "apparentTemperatureLow", "apparentTemperatureLowTime",
+    "temperatureMax", "temperatureMaxTime", "temperatureMin", "temperatureMinTime",
+    "apparentTemperatureMax", "apparentTemperatureMaxTime",
+    "apparentTemperatureMin", "apparentTemperatureMinTime",
+    "dewPoint", "humidity", "pressure", "windSpeed", "windGust", "windGustTime", "windBearing",
+    "cloudCover", "uvIndex", "uvIndexTime", "visibility", "ozone",
+)
+FIELD_SET = frozenset(FIELDS)
+# Fields holding text rather than numbers
+TEXT_FIELDS = frozenset(("summary", "icon", "precipType"))
+# Series are blocks of many data points, the rest hold a single data point
+SERIES_BLOCKS = ("minutely", "hourly")
+
+NAN = float("nan")
+
+# Field orders of the data points built so far, so points with the same fields share one tuple
+_orders = {}
+
+
+class DataPoint(object):
+    """
+    A single data point. Fields are attributes (None when absent) and can
+    also be read like the dict it was built from, e.g. point['temperature']
+    """
+    __slots__ = FIELDS + ("extra", "order")
+
+    def __init__(self, data):
+        order = tuple(data)
+        self.order = _orders.setdefault(order, order)
+        extra = None
+        for name, value in data.items():
+            if name in FIELD_SET:
+                setattr(self, name, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[name] = value
+        self.extra = extra
+
+    def get(self, name, default=None):
+        value = getattr(self, name, None) if name in FIELD_SET else (self.extra or {}).get(name)
+        return default if value is None else value
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def as_dict(self):
+        """Returns the data point as the dict Dark Sky sent"""
+        extra = self.extra or {}
+        return {name: getattr(self, name) if name in FIELD_SET else extra[name] for name in self.order}
+
+    def __repr__(self):
+        return "DataPoint(%r)" % self.as_dict()
+
+
+class Series(object):
+    """
+    The data points of a minutely or hourly block stored by column:
+    time as array('q'), numeric fields as array('d') with NaN where a
+    point lacks the field, text fields as lists. Numeric fields that only
+    ever held whole numbers are named in ints and read back as ints
+    """
+    __slots__ = ("summary", "icon", "columns", "ints")
+
+    def __init__(self, block):
+        self.summary = block.get("summary")
+        self.icon = block.get("icon")
+        data = block.get("data", [])
+        names = []
+        seen = set()
+        for point in data:
+            for name in point:
+                if name not in seen:
+                    seen.add(name)
+                    names.append(name)
+        self.columns = {}
+        ints = set()
+        for name in names:
+            if name == "time":
+                self.columns[name] = array("q", [int(point.get(name, 0)) for point in data])
+            elif name in TEXT_FIELDS or any(isinstance(point.get(name), str) for point in data):
+                self.columns[name] = [point.get(name) for point in data]
+            else:
+                self.columns[name] = array("d", [NAN if point.get(name) is None else point[name]
+                                                 for point in data])
+                if all(type(point.get(name, 0)) is int for point in data):
+                    ints.add(name)
+        self.ints = frozenset(ints)
+
+    def __len__(self):
+        time = self.columns.get("time")
+        return len(time) if time is not None else 0
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def column(self, name):
+        """Returns the column for name, or a column of NaN if no point has the field"""
+        if name in self.columns:
+            return self.columns[name]
+        return array("d", [NAN]) * len(self)
+
+    def point(self, index):
+        """Returns the data point at index as a dict"""
+        point = {}
+        for name, column in self.columns.items():
+            value = column[index]
+            if isinstance(column, array) and column.typecode == "d":
+                # NaN marks a field the point lacks
+                if value != value:
+                    continue
+                if name in self.ints:
+                    value = int(value)
+            point[name] = value
+        return point
+
+    def as_dict(self):
+        """Returns the block as the dict Dark Sky sent"""
+        block = {"data": [self.point(index) for index in range(len(self))]}
+        for name in ("summary", "icon"):
+            if getattr(self, name) is not None:
+                block[name] = getattr(self, name)
+        return block
+
+
+class ForecastModel(object):
+    """
+    Typed view of a Dark Sky response. Each block is converted the first time
+    it is accessed and then removed from the response, so only the blocks a
+    caller uses are ever built and their raw dicts are released once they are
+    """
+    def __init__(self, response):
+        self.response = response
+        self.built = {}
+        self.latitude = response.get("latitude")
+        self.longitude = response.get("longitude")
+        self.timezone = response.get("timezone")
+        self.offset = response.get("offset")
+
+    def block(self, name):
+        """Returns the named block as a DataPoint, a list of DataPoints or a Series, or None if absent"""
+        if name not in self.built:
+            raw = self.response.pop(name, None)
+            if raw is None:
+                built = None
+            elif name in SERIES_BLOCKS:
+                built = Series(raw)
+            elif name == "daily":
+                built = [DataPoint(point) for point in raw.get("data", [])]
+            else:
+                built = DataPoint(raw)
+            self.built[name] = built
+        return self.built[name]
+
+    @property
+    def currently(self):
+        return self.block("currently")
+
+    @property
+    def minutely(self):
+        return self.block("minutely")
+
+    @property
+    def hourly(self):
+        return self.block("hourly")
+
+    @property
+    def daily(self):
+        return self.block("daily")
@@ -0,0 +1,297 @@
+import json, os, queue, threading, time
+from collections import deque
+
+import timing
+from config import ParseConfig
+
+"""
+Forecast and geocoding providers
+
+Forecast and Locator fetch through a provider rather than from one API.
+Forecast providers return the JSON text of a Dark Sky style response in SI
+units; geocoding providers return (latitude, longitude). Providers are named
+in rain.conf as "name" or "name:argument", e.g.
+
+    providers = darksky, file:~/forecast.json
+    geocoder = google
+
+When several forecast providers are listed, the first is asked first and the
+others back it up: a HedgedProvider asks the next one as well when the first
+fails or is slower than usual, and returns whichever answers first
+"""
+
+DARKSKY_HOST = "api.darksky.net"
+GEOCODE_HOST = "maps.googleapis.com"
+GEOLOCATE_HOST = "www.googleapis.com"
+REQUEST_HEADERS = {'Accept': 'application/json', 'Accept-Encoding': 'gzip', 'Content-Type': 'application/json'}
+
+# A request slower than this percentile of its provider's recent latencies is hedged
+HEDGE_PERCENTILE = 95
+# Seconds to wait before hedging until a provider has MIN_SAMPLES latencies recorded
+HEDGE_DELAY = 1.0
+MIN_SAMPLES = 20
+# Recent latencies kept per provider
+LATENCY_WINDOW = 200
+
+
+class ProviderError(LookupError):
+    """A provider could not answer: the upstream failed, is unreachable or rejected the request"""
+
+
+class ForecastProvider(object):
+    """Interface of forecast providers. Both methods return SI Dark Sky JSON text"""
+    name = None
+
+    def forecast(self, location, excludes=()):
+        """Returns the forecast for location, a "lat,lon" string, without the blocks in excludes"""
+        raise NotImplementedError
+
+    def time_machine(self, location, day):
+        """Returns the hourly and daily blocks for location on day, a local "YYYY-MM-DD" date"""
+        raise NotImplementedError
+
+
+class GeocodeProvider(object):
+    """Interface of geocoding providers. Both methods return (latitude, longitude), or None if nothing was found"""
+    name = None
+
+    def geocode(self, address):
+        """Locates a street address"""
+        raise NotImplementedError
+
+    def geolocate(self, mac):
+        """Locates this device from its MAC address"""
+        raise NotImplementedError
+
+
+class DarkSkyProvider(ForecastProvider):
+    """The Dark Sky API. key defaults to the darksky_key setting"""
+    name = "darksky"
+
+    def __init__(self, key=None, pool=None):
+        self.key = key
+        self.pool = pool
+
+    def request(self, path):
+        import transport
+        key = self.key or ParseConfig().read_setting("darksky_key")
+        response = (self.pool or transport.default_pool).request(
+            'GET', DARKSKY_HOST, '/forecast/%s/%s' % (key, path), headers=REQUEST_HEADERS)
+        # Counted once an answer came back, so refusals by an open circuit don't count
+        timing.count("api.calls")
+        # Bad requests come back as Dark Sky error JSON; only a failing upstream is the provider's fault
+        if response.status >= 500:
+            raise ProviderError("%s: HTTP %s %s" % (self.name, response.status, response.reason))
+        return response.text
+
+    def forecast(self, location, excludes=()):
+        return self.request('%s?units=si&exclude=%s' % (location, ",".join(excludes)))
+
+    def time_machine(self, location, day):
+        # Noon local time selects that local day's hourly and daily blocks
+        return self.request('%s,%sT12:00:00?units=si&exclude=currently,minutely,alerts,flags' % (location, day))
+
+
+class GoogleProvider(GeocodeProvider):
+    """The Google Maps Geocoding and Geolocation APIs. key defaults to the maps_key setting"""
+    name = "google"
+
+    def __init__(self, key=None, pool=None):
+        self.key = key
+        self.pool = pool
+
+    def request(self, method, host, path, body=None):
+        import transport
+        response = (self.pool or transport.default_pool).request(method, host, path, body, REQUEST_HEADERS)
+        timing.count("api.calls")
+        if response.status >= 500:
+            raise ProviderError("%s: HTTP %s %s" % (self.name, response.status, response.reason))
+        response = json.loads(response.text)
+        if "error" in response:
+            error = response['error']
+            raise ProviderError("%s - %s (reason: %s)" % (error['code'], error['message'],
+                                                          error['errors'][0]['reason']))
+        return response
+
+    def api_key(self):
+        key = self.key or ParseConfig().read_setting("maps_key")
+        if not key:
+            raise ProviderError("You must add your Google Maps API key to rain.conf")
+        return key
+
+    def geocode(self, address):
+        import urllib.parse
+        query = urllib.parse.urlencode({'address': address, 'key': self.api_key()})
+        response = self.request('GET', GEOCODE_HOST, '/maps/api/geocode/json?%s' % query)
+        try:
+            location = response['results'][0]['geometry']['location']
+        except (KeyError, IndexError):
+            return None
+        return location['lat'], location['lng']
+
+    def geolocate(self, mac):
+        import urllib.parse
+        query = urllib.parse.urlencode({'key': self.api_key()})
+        # IP-based when Google doesn't know the access point
+        request = json.dumps({'considerIp': True, 'wifiAccessPoints': [{'macAddress': mac}]})
+        response = self.request('POST', GEOLOCATE_HOST, '/geolocation/v1/geolocate?%s' % query, request)
+        try:
+            location = response['location']
+        except KeyError:
+            return None
+        return location['lat'], location['lng']
+
+
+class FileProvider(ForecastProvider, GeocodeProvider):
+    """
+    Serves a recorded SI Dark Sky response from a JSON file, for tests and
+    offline use. Every location and day gets the same recording, relabelled
+    with the requested coordinates; geocoding returns the recording's coordinates
+    """
+    name = "file"
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as recording:
+                return json.load(recording)
+        except (OSError, ValueError) as err:
+            raise ProviderError("%s: %s" % (self.name, err))
+
+    def forecast(self, location, excludes=()):
+        response = {block: value for block, value in self.load().items() if block not in excludes}
+        latitude, longitude = location.split(",")
+        response["latitude"], response["longitude"] = float(latitude), float(longitude)
+        return json.dumps(response)
+
+    def time_machine(self, location, day):
+        return self.forecast(location, ("currently", "minutely", "alerts", "flags"))
+
+    def geocode(self, address):
+        response = self.load()
+        return response["latitude"], response["longitude"]
+
+    def geolocate(self, mac):
+        return self.geocode(mac)
+
+
+class HedgedProvider(ForecastProvider):
+    """
+    Asks providers in order, returning the first answer. The next provider is
+    asked as well as soon as the current one fails, or takes longer than
+    percentile of its recent latencies (delay seconds until it has min_samples)
+    """
+    def __init__(self, providers, percentile=HEDGE_PERCENTILE, delay=HEDGE_DELAY, min_samples=MIN_SAMPLES):
+        self.providers = list(providers)
+        self.name = "+".join(provider.name for provider in self.providers)
+        self.percentile = percentile
+        self.delay = delay
+        self.min_samples = min_samples
+        self.latencies = [deque(maxlen=LATENCY_WINDOW) for _ in self.providers]
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "hedged": 0, "failovers": 0, "alternate_wins": 0}
+
+    def forecast(self, location, excludes=()):
+        return self.call("forecast", location, excludes)
+
+    def time_machine(self, location, day):
+        return self.call("time_machine", location, day)
+
+    def hedge_delay(self, index):
+        """Returns how long to wait on provider index before asking the next one"""
+        with self.lock:
+            samples = sorted(self.latencies[index])
+        if len(samples) < self.min_samples:
+            return self.delay
+        return samples[min(len(samples) - 1, int(len(samples) * self.percentile / 100))]
+
+    def call(self, method, *args):
+        """Calls method on the providers as described above. Raises ProviderError if every one fails"""
+        results = queue.Queue()
+
+        def run(index):
+            start = time.monotonic()
+            try:
+                value = getattr(self.providers[index], method)(*args)
+            except Exception as err:
+                results.put((index, None, err))
+                return
+            # Answers that lose the race still count towards the provider's latency
+            with self.lock:
+                self.latencies[index].append(time.monotonic() - start)
+            results.put((index, value, None))
+
+        def start(index):
+            # Daemon threads, so a provider that never answers doesn't hold up exit
+            threading.Thread(target=run, args=(index,), daemon=True).start()
+
+        with self.lock:
+            self.stats["requests"] += 1
+        start(0)
+        started, pending, errors = 1, 1, []
+        while True:
+            timeout = self.hedge_delay(started - 1) if started < len(self.providers) else None
+            try:
+                index, value, error = results.get(timeout=timeout)
+            except queue.Empty:
+                with self.lock:
+                    self.stats["hedged"] += 1
+                start(started)
+                started, pending = started + 1, pending + 1
+                continue
+            pending -= 1
+            if error is None:
+                if index:
+                    with self.lock:
+                        self.stats["alternate_wins"] += 1
+                return value
+            errors.append("%s: %s" % (self.providers[index].name, error))
+            if started < len(self.providers):
+                with self.lock:
+                    self.stats["failovers"] += 1
+                start(started)
+                started, pending = started + 1, pending + 1
+            elif not pending:
+                raise ProviderError("Every provider failed: %s" % "; ".join(errors))
+
+
+FORECAST_PROVIDERS = {"darksky": DarkSkyProvider, "file": FileProvider}
+GEOCODE_PROVIDERS = {"google": GoogleProvider, "file": FileProvider}
+
+# Providers built from rain.conf, by setting, kept so hedging learns latencies across requests
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def make_provider(spec, registry):
+    """Returns the provider for spec, "name" or "name:argument", from registry"""
+    name, _, argument = spec.strip().partition(":")
+    if name not in registry:
+        raise ValueError("Unknown provider '%s', expected one of %s" % (name, ", ".join(sorted(registry))))
+    return registry[name](argument) if argument else registry[name]()
+
+
+def forecast_provider():
+    """Returns the forecast provider configured by the providers, hedge_percentile and hedge_delay settings"""
+    config = ParseConfig()
+    specs = config.read_setting("providers", "") or "darksky"
+    percentile = config.read_setting("hedge_percentile", "") or HEDGE_PERCENTILE
+    delay = config.read_setting("hedge_delay", "") or HEDGE_DELAY
+    key = ("forecast", specs, percentile, delay)
+    with _providers_lock:
+        if key not in _providers:
+            providers = [make_provider(spec, FORECAST_PROVIDERS) for spec in specs.split(",") if spec.strip()]
+            _providers[key] = providers[0] if len(providers) == 1 else \
+                HedgedProvider(providers, float(percentile), float(delay))
+        return _providers[key]
+
+
+def geocode_provider():
+    """Returns the geocoding provider configured by the geocoder setting"""
+    spec = ParseConfig().read_setting("geocoder", "") or "google"
+    with _providers_lock:
+        if ("geocode", spec) not in _providers:
+            _providers[("geocode", spec)] = make_provider(spec, GEOCODE_PROVIDERS)
+        return _providers[("geocode", spec)]
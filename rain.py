@@ -1,11 +1,10 @@
 #! /usr/bin/python3
 # -*- coding: utf-8 -*-
-import argparse, json, urllib, http.client, os, time, string, sys
-import utils
+import argparse, os, sys
+import render, timing
 from config import ParseConfig
-from datetime import datetime
-from subprocess import PIPE, Popen
-from shlex import split
+# Networking, JSON and analytics modules are imported where they're used,
+# so help and cached invocations start quickly on slow single-board computers
 
 """
 Rain - A weather application for the CLI, written in Python
@@ -29,23 +28,46 @@ class Locator(object):
     All functions sans get_mac_addr return latitude and longitude as a tuple
     """
     def get_mac_addr(self):
-        """Read MAC address from config or return MAC address via system call"""
+        """Read MAC address from config or return the MAC address of this device"""
         config = ParseConfig()
-        conf_path = os.path.dirname(__file__)
-        conf_path = os.path.join(conf_path, "rain.conf")
-
-        if os.path.isfile(conf_path) and config.read_setting("mac"):
+        if os.path.isfile(config.conf_path) and config.read_setting("mac"):
             mac = config.read_setting("mac")
             return mac
         else:
-            # Obtain devices mac addresses via system call
-            ifconfig = Popen(split("ifconfig"), stdout=PIPE)
-            # grep regexp from: https://stackoverflow.com/a/245925/3605584
-            grep = Popen(split("grep -o -E '([[:xdigit:]]{1,2}:){5}[[:xdigit:]]{1,2}'"), stdin=ifconfig.stdout, stdout=PIPE)
-            mac = grep.communicate()[0].strip()
+            with timing.span("locator.mac"):
+                mac = self.find_mac_addr()
             config.write_setting("mac", mac)
             return mac
 
+    def find_mac_addr(self):
+        """
+        Returns the MAC address of the first network interface that has one,
+        read from /sys/class/net, or via ifconfig where sysfs is unavailable
+        """
+        net_path = "/sys/class/net"
+        if os.path.isdir(net_path):
+            for interface in sorted(os.listdir(net_path)):
+                try:
+                    with open(os.path.join(net_path, interface, "address"), "r") as address_file:
+                        mac = address_file.read().strip()
+                except OSError:
+                    continue
+                # Loopback and virtual interfaces report all zeros
+                if mac and mac.strip("0:"):
+                    return mac
+            raise LookupError("No network interface with a MAC address found")
+
+        # Obtain devices mac addresses via system call
+        from subprocess import PIPE, Popen
+        from shlex import split
+        ifconfig = Popen(split("ifconfig"), stdout=PIPE)
+        # grep regexp from: https://stackoverflow.com/a/245925/3605584
+        grep = Popen(split("grep -o -E '([[:xdigit:]]{1,2}:){5}[[:xdigit:]]{1,2}'"), stdin=ifconfig.stdout, stdout=PIPE)
+        macs = grep.communicate()[0].decode().split()
+        if not macs:
+            raise LookupError("No network interface with a MAC address found")
+        return macs[0]
+
     def get_coordinates(self):
         """
         Read location data from file if available, otherwise
@@ -53,176 +75,252 @@ class Locator(object):
         Returns latitude and longitude as a tuple
         """
         config = ParseConfig()
-        conf_path = os.path.dirname(__file__)
-        conf_path = os.path.join(conf_path, "rain.conf")
-
-        if os.path.isfile(conf_path):
+        if os.path.isfile(config.conf_path):
             # Parse config file for coordinates
             coordinates = config.read_setting("coordinates")
             if coordinates:
                 return coordinates
             else:
-                try:
-                    # Get mac address to send to Geolocate API
-                    mac = self.get_mac_addr()
-                    # If obtaining mac fails, send home address to Geocode API
-                except:
-                    print("Obtaining coordinates via geocoding of physical address")
-                    coordinates = ', '.join(map(str, self.goog_geocode(address)))
-                # Otherwise, send mac address
-                else:
+                # Any MAC address found is written together with the coordinates
+                with config.batch():
                     try:
-                        print("Obtaining coordinates via geolocation of mac address")
-                        coordinates = ', '.join(map(str, self.goog_geolocate(mac)))
+                        # Get mac address to send to Geolocate API
+                        mac = self.get_mac_addr()
+                        # If obtaining mac fails, send home address to Geocode API
                     except:
-                        # If sending mac address to get coordinates fails
-                        # send residental address to Geocode API
                         print("Obtaining coordinates via geocoding of physical address")
-                        coordinates = ', '.join(map(str, self.goog_geocode(address)))
-                # Write geocoordinates to file
-                config.write_setting("coordinates", coordinates)
+                        coordinates = ', '.join(map(str, self.goog_geocode(config.read_setting("address"))))
+                    # Otherwise, send mac address
+                    else:
+                        try:
+                            print("Obtaining coordinates via geolocation of mac address")
+                            coordinates = ', '.join(map(str, self.goog_geolocate(mac)))
+                        except:
+                            # If sending mac address to get coordinates fails
+                            # send residental address to Geocode API
+                            print("Obtaining coordinates via geocoding of physical address")
+                            coordinates = ', '.join(map(str, self.goog_geocode(config.read_setting("address"))))
+                    # Write geocoordinates to file
+                    config.write_setting("coordinates", coordinates)
                 print("Wrote coordinates to rain.conf")
                 return coordinates
         else:
-            print("rain.conf not found!")
-            print("Generating rain.conf...")
-            config.generate_conf()
-            print("Add your Dark Sky API key to rain.conf and execute rain again")
-            sys.exit(1)
+            require_conf(config)
 
     def goog_geocode(self, address):
         """
         Send residental (home) address to Google Maps Geocoding API
         Returns latitude and longitude as a tuple
         """
+        import providers
+        from cache import GeocodeCache
         config = ParseConfig()
-        maps_key = config.read_setting("maps_key")
-
-        if not maps_key:
-            print("Cannot obtain coordinates from geocoding API")
-            print("You must add your Google Maps API key to rain.conf")
-            sys.exit(1)
 
         # Get address from config if running client only
         if config.read_setting("server") == "no":
-            address = address.translate(string.punctuation)
-            address = config.read_setting("address").replace(" ", "+")
-            # When running rain-server, address will be sent to rain-server via
-            # POST request and urlencoded here, when goog_geocode() is called in Flask
-        elif config.read_setting("server") == "yes":
-            address = address.translate(string.punctuation)
-            address = address.replace(" ", "+")
-
-        request_headers = {'Accept':'application/json', 'Accept-Encoding':'gzip', 'Content-Type':'application/json'}
-        request = urllib.parse.urlencode({'address': address})
-        connection = http.client.HTTPSConnection('maps.googleapis.com')
-        request_path = '/maps/api/geocode/json?address=%s' % (address)
-        connection.request('POST', request_path, request)
-        response = connection.getresponse().read().decode()
-        connection.close()
+            address = config.read_setting("address")
+        # When running rain-server, address is sent to rain-server via POST request
+        # The geocoding provider urlencodes it either way
+
+        geocache = GeocodeCache()
+        cached = geocache.get("address", address)
+        if cached:
+            timing.count("geocode.cache_hits")
+            return cached
 
         # Handle errors in API response
-        if "error" in json.loads(response):
-            err_code = json.loads(response)['error']['code']
-            err_msg = json.loads(response)['error']['message']
-            err_reason = json.loads(response)['error']['errors'][0]['reason']
-            print("Error: %s - %s (reason: %s)" % (err_code, err_msg, err_reason))
+        try:
+            with timing.span("locator.geocode"):
+                coordinates = providers.geocode_provider().geocode(address)
+        except providers.ProviderError as err:
+            print("Cannot obtain coordinates from geocoding API")
+            print("Error: %s" % err)
             sys.exit(1)
+        if coordinates is None:
+            print("Geocoding API could not obtain coordinates")
         else:
-            try:
-                lat = json.loads(response)['results'][0]['geometry']['location']['lat']
-                lon = json.loads(response)['results'][0]['geometry']['location']['lng']
-                return lat, lon
-            except:
-                print("Geocoding API could not obtain coordinates")
+            geocache.put("address", address, coordinates)
+            return coordinates
 
     def goog_geolocate(self, mac):
         """
         Send MAC address to Google Maps Geolocate API
         Returns latitude and longitude as a tuple
         """
-        config = ParseConfig()
-        maps_key = config.read_setting("maps_key")
+        import providers
+        from cache import GeocodeCache
 
-        if not maps_key:
-            print("Cannot obtain coordinates from geolocation API")
-            print("You must add your Google Maps API key to rain.conf")
-            sys.exit(1)
-
-        request_headers = {'Accept':'application/json', 'Accept-Encoding':'gzip', 'Content-Type':'application/json'}
-        request = urllib.parse.urlencode({'macAddress':'mac', 'considerIp':'true'})
-        connection = http.client.HTTPSConnection('www.googleapis.com')
-        request_path = '/geolocation/v1/geolocate?key=%s' % (maps_key)
-        connection.request('POST', request_path, request)
-        response = connection.getresponse().read().decode()
-        connection.close()
+        geocache = GeocodeCache()
+        cached = geocache.get("mac", mac)
+        if cached:
+            timing.count("geocode.cache_hits")
+            return cached
 
         # Handle errors in API response
-        if "error" in json.loads(response):
-            err_code = json.loads(response)['error']['code']
-            err_msg = json.loads(response)['error']['message']
-            err_reason = json.loads(response)['error']['errors'][0]['reason']
-            print("Error: %s - %s (reason: %s)" % (err_code, err_msg, err_reason))
+        try:
+            with timing.span("locator.geolocate"):
+                coordinates = providers.geocode_provider().geolocate(mac)
+        except providers.ProviderError as err:
+            print("Cannot obtain coordinates from geolocation API")
+            print("Error: %s" % err)
             sys.exit(1)
+        if coordinates is None:
+            print("Geolocation API could not obtain coordinates")
         else:
-            try:
-                lat = json.loads(response)['location']['lat']
-                lon = json.loads(response)['location']['lng']
-                return lat, lon
-            except:
-                print("Geolocation API could not obtain coordinates")
+            geocache.put("mac", mac, coordinates)
+            return coordinates
+
+# Forecasts fetched at once by Forecast.get_weather_many
+MAX_WORKERS = 8
+# Where --serve listens and --via-daemon connects by default
+DAEMON_ADDRESS = "127.0.0.1:8361"
 
 class Forecast(object):
     """
     Returns forecast object via Dark Sky API
     Developer's documentation: https://darksky.net/dev/docs
     """
-    def get_weather(self, coordinates, forecast):
+    def get_weather(self, coordinates, forecast, use_cache=True, max_age=None, units=None, daemon=None):
         """
         Takes a tuple of latitude, longitude and returns
         the weather forecast in JSON format. Forecast: include a list of data-blocks.
         Values for forecast: currently, minutely, hourly, daily, alerts, flags
+        Responses are served from the on-disk cache while younger than max_age seconds
+        (default: the TTL of the requested blocks). use_cache=False forces a fresh fetch
+        Data is always fetched in SI and converted to units (default: the units setting)
+        If daemon ("host:port") is given, the forecast is read from a running rain daemon instead
+        If fetching fails and use_cache is set, the last cached response is used however old
+        Errors reported by Dark Sky are returned as the response, with its code and error keys
         """
+        import json
+        import units as unit_systems
+        from cache import ResponseCache, snap_coordinates
+        from model import ForecastModel
         config = ParseConfig()
-        try:
-            darksky_key = config.read_setting('darksky_key')
-        except:
-            print("No Dark Sky API key found in rain.conf!")
 
         # Set unit to auto if None
-        units = config.read_setting('units')
         if not units:
-            units = 'auto'
+            units = config.read_setting('units') or 'auto'
         self.forecast_list = []
         self.forecast_list = ["currently", "minutely", "hourly", "daily", "alerts", "flags"]
         self.includes = []
         self.excludes = []
 
-        if forecast is "all":
+        if forecast == "all":
             self.includes = self.forecast_list
-        elif forecast is not "all":
+        else:
             # Always include weather alerts
             self.includes = ["alerts"]
             self.includes.extend(forecast)
 
         # Forecasts to be excluded are the items in forecast_list that are not in forecast (input by user)
         self.excludes = ",".join([item for item in self.forecast_list if item not in self.includes])
-        request_headers = {'Accept':'application/json', 'Accept-Encoding':'gzip', 'Content-Type':'application/json'}
-        connection = http.client.HTTPSConnection('api.darksky.net')
-        request_path = '/forecast/%s/%s?units=%s&exclude=%s' % (darksky_key, coordinates, units, self.excludes)
-        connection.request('GET', request_path)
-        # Decode needed by Python 3 to avoid str not byte error
-        response = connection.getresponse().read().decode('utf-8')
-        connection.close()
-        self.response = json.loads(response)
-
-        if "error" in response:
-            err_txt = self.response['error']
-            err_code = self.response['code']
-            print("Error: %s - %s" % (err_code,err_txt))
+        # Nearby coordinates snapped to the same grid point share one request and cache entry
+        grid = config.read_setting('grid', '')
+        location = snap_coordinates(coordinates, float(grid) if grid else 0)
+
+        cache = ResponseCache()
+        # Every unit system shares the one SI response, converted below
+        cache_key = cache.make_key(location, 'si', self.excludes)
+        if max_age is None:
+            # Alerts ride along with every request, so only the requested blocks set the TTL
+            max_age = cache.ttl(self.forecast_list if forecast == "all" else forecast)
+        with timing.span("forecast.cache"):
+            response = cache.get(cache_key, max_age) if use_cache and not daemon else None
+        fetched = False
+        if use_cache and not daemon:
+            timing.count("cache.hits" if response is not None else "cache.misses")
+
+        if daemon:
+            import daemon as rain_daemon
+            with timing.span("forecast.fetch", source="daemon"):
+                response = rain_daemon.fetch(daemon, location)
+        elif response is None:
+            import providers
+            provider = providers.forecast_provider()
+            try:
+                with timing.span("forecast.fetch", source=provider.name):
+                    response = provider.forecast(location, self.excludes.split(",") if self.excludes else [])
+            except Exception as err:
+                # Upstream failing, its circuit open or out of time: fall back to the last response, however old
+                age = cache.age(cache_key) if use_cache else None
+                if age is None:
+                    raise
+                timing.count("cache.stale")
+                sys.stderr.write("Warning: %s. Showing the forecast fetched %d minutes ago\n" % (err, age // 60))
+                response = cache.get(cache_key, age + 1)
+            else:
+                fetched = True
+        # The SI response, for comparing with later forecasts in get_changes()
+        self.location = location
+        self.text = response
+        with timing.span("forecast.decode"):
+            self.response = json.loads(response)
+        # Dark Sky reports bad requests as a top-level error; words in alerts and summaries don't count
+        if fetched and "error" not in self.response:
+            cache.put(cache_key, response)
+        if "error" not in self.response:
+            with timing.span("forecast.convert"):
+                self.units = unit_systems.convert_response(self.response, units)
+        # Blocks are only converted when first read from the model, which then takes them out of self.response
+        self.model = ForecastModel(self.response)
 
         return self.response
 
+    def get_weather_many(self, coords_list, forecast, concurrency=MAX_WORKERS, **cache_opts):
+        """
+        Fetches the forecast for every coordinate pair in coords_list using up to
+        concurrency requests at once. Yields (coordinates, Forecast, error) as each
+        location completes; error is None on success, otherwise the Forecast is None
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        def fetch(coordinates):
+            site = Forecast()
+            site.get_weather(coordinates, forecast, **cache_opts)
+            return site
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            futures = {executor.submit(fetch, coordinates): coordinates for coordinates in coords_list}
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result(), None
+                except Exception as err:
+                    # One failing location must not stop the rest of the sweep
+                    yield futures[future], None, err
+
+    def get_weather_at(self, coordinates, day):
+        """
+        Returns the SI time-machine forecast for coordinates on day, a "YYYY-MM-DD"
+        date in the location's local time. For past days it holds observed conditions
+        Raises LookupError if Dark Sky returns an error
+        """
+        import json
+        import providers
+        from model import ForecastModel
+        provider = providers.forecast_provider()
+        with timing.span("forecast.fetch", source=provider.name, day=day):
+            response = provider.time_machine("".join(coordinates.split()), day)
+        with timing.span("forecast.decode"):
+            self.response = json.loads(response)
+        if "error" in self.response:
+            raise LookupError("%s - %s" % (self.response.get('code'), self.response['error']))
+        self.units = "si"
+        self.model = ForecastModel(self.response)
+        return self.response
+
+    def get_changes(self, tracker=None):
+        """
+        Returns changes.diff() of the last reported forecast for this location and
+        the one get_weather() fetched, in self.units, and makes this one the last
+        reported if anything changed. tracker defaults to a changes.ChangeTracker()
+        """
+        import json
+        import changes
+        tracker = tracker or changes.ChangeTracker()
+        found = tracker.update(self.location, json.loads(self.text))
+        return changes.convert_changes(found, self.units)
+
     def get_alerts(self):
         """Returns special weather advisories"""
         if 'alerts' in self.response:
@@ -233,82 +331,114 @@ class Forecast(object):
 
     def get_currently(self):
         """
-        Get current weather condition as a dict.
+        Get current weather condition as a model.DataPoint, read like a dict.
         Makes accessible weather data
         already obtained via get_weather(coordinates)
         """
-        self.currently = self.response['currently']
+        self.currently = self.model.currently
         return self.currently
 
     def get_minutely(self):
         """Returns today's minute-by-minute forecast as a nested dict"""
-        self.includes = ["minutely"]
-        self.minutely = self.response['minutely']
+        self.minutely = self.model.minutely.as_dict()
         return self.minutely
 
     def get_hourly(self):
         """Returns today's hourly forecast as a nested dict"""
-        self.includes = ["hourly"]
-        self.hourly = self.response['hourly']
+        self.hourly = self.model.hourly.as_dict()
         return self.hourly
 
+    def get_minutely_series(self):
+        """Returns the minute-by-minute forecast as a model.Series of array-backed columns"""
+        return self.model.minutely
+
+    def get_hourly_series(self):
+        """Returns the hourly forecast as a model.Series of array-backed columns"""
+        return self.model.hourly
+
     def get_daily(self, day):
-        """Returns daily forecasts (for the next 5 days) as a dict"""
-        self.daily = self.response['daily']['data'][day]
+        """Returns daily forecasts (for the next 5 days) as a model.DataPoint, read like a dict"""
+        self.daily = self.model.daily[day]
         return self.daily
 
     def print_currently(self):
         """Prints current weather conditions"""
         if "currently" in self.includes:
-            print("\nCurrent time: %s" % utils.convert_unixtime(forecast.currently['time']))
-            print("Current condition: %s" % forecast.currently['summary'])
-            print("Current temperature: %s F" % round(int(forecast.currently['temperature'])))
-            print("Current humidity: %s%%" % round(forecast.currently['humidity']*100))
-            print("Chance of rain: %s%%" % round(forecast.currently['precipProbability']*100))
-            print("Nearest storm: %s mi." % forecast.currently['nearestStormDistance'])
-            print("Cloud cover: %s%%" % round((forecast.currently['cloudCover']*100)))
-            print("Dewpoint: %s\N{DEGREE SIGN}" % round(forecast.currently['dewPoint']))
-            print("Current pressure: %s millibars" % round(forecast.currently['pressure']))
-            print("Wind speed: %s mph" % round(forecast.currently['windSpeed']))
-            print("Wind gust: %s mph" % round(forecast.currently['windGust']))
-            print("Wind bearing: %s" % utils.convert_wind(forecast.currently['windBearing']))
-            print("Visibility: %s mi.\n" % round(forecast.currently['visibility']))
-        if "minutely" in self.includes:
-            print("Upcoming: %s\n" % forecast.minutely['summary'])
+            sys.stdout.write(render.text_currently(self, "minutely" in self.includes))
+
+    def print_series(self, series, heat=None):
+        """Prints the analytics.summarize() headlines for a minutely or hourly model.Series"""
+        sys.stdout.write(render.text_series(self, series, heat))
+
+    def print_hourly(self, heat=None):
+        """Prints a summary of the hourly forecast"""
+        self.print_series(self.get_hourly_series(), heat)
+
+    def print_minutely(self):
+        """Prints a summary of the minute-by-minute forecast for the next hour"""
+        self.print_series(self.get_minutely_series())
 
     def print_daily(self, day):
-        """Prints forecast for the day specified by forecast.get_daily(day)"""
-        print("Day: %s" % utils.convert_dayofweek(self.get_daily(day)['time']))
-        print("Summary: %s" % forecast.daily['summary'])
-        print("High Temp.: %s at %s" % (
-            round(forecast.daily['temperatureMax']), utils.convert_unixtime(
-                forecast.daily['temperatureMaxTime'])))
-        print("Low Temp.: %s at %s" % (
-            round(forecast.daily['temperatureMin']), utils.convert_unixtime(
-                forecast.daily['temperatureMinTime'])))
-        print("Humidity: %s%%" % (round(forecast.daily['humidity']*100)))
-        print("Chance of rain: %s%%" % (round(forecast.daily['precipProbability']*100)))
-        print("Dewpoint: %s\N{DEGREE SIGN}" % round(forecast.daily['dewPoint']))
-        print("Pressure: %s millibars" % round(forecast.daily['pressure']))
-        print("Wind speed: %s mph" % round(forecast.daily['windSpeed']))
-        print("Sunrise: %s" % utils.convert_unixtime(forecast.daily['sunriseTime']))
-        print("Sunset: %s" % utils.convert_unixtime(forecast.daily['sunsetTime']))
-        print("Moon Phase: %s\n" % utils.convert_moonphase(forecast.daily['moonPhase']))
+        """Prints forecast for the day specified by self.get_daily(day)"""
+        self.get_daily(day)
+        sys.stdout.write(render.text_daily(self, day))
 
     def print_alert(self):
         """Prints weather alerts, if available"""
-        if forecast.alert:
-            print("Special weather advisory: %s %s" % (
-                utils.convert_unixtime(forecast.response['alerts'][0]['time']), forecast.alert))
-            print("Severity: %s" % forecast.response['alerts'][0]['severity'])
-            print("Regions: %s" % ", ".join(forecast.response['alerts'][0]['regions']))
-            print("Expires: %s\n" % utils.convert_unixtime(forecast.response['alerts'][0]['expires']))
+        sys.stdout.write(render.text_alert(self))
+
+def require_conf(config):
+    """Generates rain.conf and exits if it doesn't exist yet"""
+    if not os.path.isfile(config.conf_path):
+        print("rain.conf not found!")
+        print("Generating rain.conf...")
+        config.generate_conf()
+        print("Add your Dark Sky API key to rain.conf and execute rain again")
+        sys.exit(1)
+
+def read_locations(path):
+    """Returns the coordinates listed one per line in path, skipping blanks and # comments"""
+    with open(path, "r") as sites:
+        return [line.strip() for line in sites if line.strip() and not line.startswith("#")]
+
+def requested_blocks(args):
+    """Returns the data blocks needed by every section selected on the command line"""
+    return [block for block, wanted in (("currently", args.currently), ("minutely", args.minutely),
+            ("hourly", args.hourly), ("daily", args.day or args.weekly)) if wanted]
+
+def requested_sections(args):
+    """Returns the render.make_sections() selected on the command line"""
+    return render.make_sections(args.currently, args.minutely, args.hourly, args.day or (),
+                                args.weekly, args.heat)
+
+def report_changes(sites, format="text", hook=None):
+    """
+    Prints what changed since the last reported forecast for each (label, Forecast)
+    in sites, nothing if nothing did, and runs the shell command hook for every
+    location with changes. label is None for a single forecast
+    """
+    import changes
+    tracker = changes.ChangeTracker()
+    found = [(label, site, site.get_changes(tracker)) for label, site in sites]
+    sys.stdout.write(render.render_changes(found, format))
+    sys.stdout.flush()
+    if hook:
+        for label, site, site_changes in found:
+            if site_changes and changes.run_hook(hook, site.location, site.units, site_changes):
+                sys.stderr.write("Warning: hook failed for %s\n" % site.location)
+
+def print_profile(trace=None):
+    """Prints the time spent in each phase and the counters to stderr, and saves a Chrome trace to trace if given"""
+    out = [render.render_rows(timing.breakdown(), ("phase", "calls", "total_ms", "max_ms"))]
+    out.append("total: %.2f ms since start\n" % (timing.elapsed() * 1000))
+    out.extend("%s: %s\n" % (name, value) for name, value in sorted(timing.counters().items()))
+    if trace:
+        timing.write_trace(trace)
+        out.append("Wrote trace to %s\n" % trace)
+    sys.stderr.write("".join(out))
 
 # Main
 if __name__ == '__main__':
-    forecast = Forecast()
-    locate = Locator()
-    coordinates = locate.get_coordinates()
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--currently", help="Display currrent weather conditions",
                             action="store_true")
@@ -320,50 +450,154 @@ if __name__ == '__main__':
                                 action="store_true")
     parser.add_argument("-w", "--weekly", help="Display 5-day weather forecast (same as 'rain -d 0 1 2 3 4')",
                                 action="store_true")
+    parser.add_argument("--heat", help="With -o, count the hours at or above this temperature",
+                                action="store", type=float, metavar="TEMPERATURE")
+    parser.add_argument("--locations", help="Display forecasts for every location in FILE, one 'latitude, longitude' per line",
+                                action="store", metavar="FILE")
+    parser.add_argument("--concurrency", help="Number of locations fetched at once with --locations (default: %d)" % MAX_WORKERS,
+                                action="store", type=int, default=MAX_WORKERS)
+    parser.add_argument("--serve", help="Run the rain daemon, serving forecasts as JSON over HTTP on HOST:PORT (default: %s)" % DAEMON_ADDRESS,
+                                action="store", nargs="?", const=DAEMON_ADDRESS, metavar="HOST:PORT")
+    parser.add_argument("--via-daemon", help="Read forecasts from a running rain daemon (default: %s)" % DAEMON_ADDRESS,
+                                action="store", nargs="?", const=DAEMON_ADDRESS, metavar="HOST:PORT")
+    parser.add_argument("--backfill", help="Store observed weather for every day from START to END (YYYY-MM-DD) for the configured location or --locations",
+                                action="store", nargs=2, metavar=("START", "END"))
+    parser.add_argument("--history", help="Display weather stored by --backfill from START to END (YYYY-MM-DD) without going online",
+                                action="store", nargs=2, metavar=("START", "END"))
+    parser.add_argument("--group", help="With --history, aggregate by hour, day, month or year (default: day)",
+                                action="store", choices=("hour", "day", "month", "year"), default="day")
+    parser.add_argument("--changes-only", help="Only display what changed since the last forecast displayed this way, and nothing if nothing did",
+                                action="store_true")
+    parser.add_argument("--hook", help="With --changes-only, run COMMAND with the changes as JSON on stdin (default: the change_hook setting)",
+                                action="store", metavar="COMMAND")
+    parser.add_argument("--format", help="Output format: %s (default: text)" % ", ".join(render.FORMATS),
+                                action="store", choices=render.FORMATS, default="text")
+    parser.add_argument("--profile", help="Print the time spent in each phase to stderr, and save a Chrome trace to TRACE_FILE if given",
+                                action="store", nargs="?", const="", metavar="TRACE_FILE")
+    parser.add_argument("--deadline", help="Give up on network requests after this many seconds in total (default: the deadline setting)",
+                                action="store", type=float, metavar="SECONDS")
+    parser.add_argument("--no-cache", help="Ignore cached responses and fetch a fresh forecast",
+                                action="store_true")
+    parser.add_argument("--max-age", help="Serve cached responses up to this many seconds old",
+                                action="store", type=int, metavar="SECONDS")
     args = parser.parse_args()
+    if args.profile is not None:
+        import atexit
+        timing.enable()
+        # Reported however rain exits
+        atexit.register(print_profile, args.profile)
+    if args.changes_only and not requested_blocks(args):
+        # Track current conditions and the daily forecast unless told otherwise
+        args.currently = args.weekly = True
+    # Display help if no arguments are supplied, if -d is called with no values,
+    # or if nothing would be displayed
+    if len(sys.argv) == 1 or args.day == [] or not (requested_blocks(args) or args.serve or args.locations
+                                                    or args.backfill or args.history):
+        parser.print_help()
+        sys.exit(0)
+    if args.backfill or args.history:
+        import history
+        try:
+            history.date_range(*(args.backfill or args.history))
+        except ValueError:
+            parser.error("dates must be given as YYYY-MM-DD")
+
+    cache_opts = {'use_cache': not args.no_cache, 'max_age': args.max_age, 'daemon': args.via_daemon}
     config = ParseConfig()
+    # Every mode reads settings, so a first run generates rain.conf before anything else
+    require_conf(config)
+    # Long-running modes are only bounded when asked to be
+    deadline = args.deadline
+    if deadline is None and not (args.serve or args.backfill):
+        deadline = float(config.read_setting("deadline", "") or 0) or None
+    timing.set_deadline(deadline)
     # Parse rain.conf
     units = config.read_setting("units")
     server = config.read_setting("server")
     darksky_key = config.read_setting("darksky_key")
-
-    if args.currently:
-        forecast.get_weather(coordinates, ["currently"])
-        forecast.get_currently()
-        forecast.print_currently()
-        forecast.get_alerts()
-        forecast.print_alert()
-    elif args.hourly:
-        forecast.get_weather(coordinates, ["hourly"])
-        forecast.get_hourly()
-        forecast.get_alerts()
-        forecast.print_alert()
-    elif args.day:
-        forecast.get_weather(coordinates, ["daily"])
-        print('')
-        # Get forecast for each day specified
-        for day in args.day:
-            forecast.get_daily(int(day))
-            forecast.print_daily(int(day))
-        forecast.get_alerts()
-        forecast.print_alert()
-    elif args.weekly:
-        forecast.get_weather(coordinates, ["daily"])
-        print('')
-        for x in range(0, 6):
-                forecast.get_daily(x)
-                forecast.print_daily(x)
-                print('-' * 25)
-        forecast.get_alerts()
-        forecast.print_alert()
-    elif args.minutely:
-        forecast.get_weather(coordinates, ["minutely"])
-        forecast.get_minutely()
-        forecast.get_alerts()
-        forecast.print_alert()
-    # Display help if -d is called with no values
-    elif args.day == []:
-        parser.print_help()
-    # Display help if no arguments are supplied
-    if len(sys.argv)==1:
-        parser.print_help()
+    forecast = Forecast()
+    locate = Locator()
+    # A --locations sweep brings its own coordinates
+    coordinates = locate.get_coordinates() if not args.locations else None
+
+    if args.serve:
+        import daemon as rain_daemon
+        budget = config.read_setting("daily_budget", "")
+        grid = config.read_setting("grid", "")
+        rain_daemon.serve(Forecast, args.serve, coordinates, units or 'auto',
+                          int(budget) if budget else rain_daemon.DAILY_BUDGET, args.max_age or 0,
+                          float(grid) if grid else 0)
+    elif args.backfill or args.history:
+        from cache import snap_coordinates
+        grid = config.read_setting("grid", "")
+        # Stored under the same grid points as live forecasts
+        sites = [snap_coordinates(site, float(grid) if grid else 0)
+                 for site in (read_locations(args.locations) if args.locations else [coordinates])]
+        store = history.HistoryStore()
+        try:
+            if args.backfill:
+                def report(site, day, error):
+                    if error:
+                        print("Error: %s on %s: %s" % (site, day, error))
+                fetched, skipped, failed = history.backfill(store, Forecast, sites, args.backfill[0],
+                                                            args.backfill[1], args.concurrency, report)
+                print("Stored %d days (%d already stored, %d failed)" % (fetched, skipped, failed))
+            else:
+                rows = []
+                for site in sites:
+                    site_rows = store.aggregate(site, args.history[0], args.history[1], args.group)
+                    site_units = store.convert(site, site_rows, units or 'auto')
+                    for row in site_rows:
+                        row.update(location=site, units=site_units)
+                    rows.extend(site_rows)
+                columns = ("location",) + history.AGGREGATE_COLUMNS + ("units",)
+                with timing.span("render"):
+                    sys.stdout.write(render.render_rows(rows, columns, args.format))
+        finally:
+            store.close()
+    elif args.locations:
+        # Show current conditions when no section is selected
+        args.currently = args.currently or not requested_blocks(args)
+        coords_list = read_locations(args.locations)
+        renderer = render.get_renderer(args.format)
+        sections = requested_sections(args)
+        changed_sites = []
+        for coords, site, error in forecast.get_weather_many(coords_list, requested_blocks(args),
+                                                             args.concurrency, **cache_opts):
+            if error is None and "error" in site.response:
+                error = "%s - %s" % (site.response.get('code'), site.response['error'])
+            if args.changes_only:
+                if error:
+                    sys.stderr.write("Error: %s: %s\n" % (coords, error))
+                else:
+                    changed_sites.append((coords, site))
+                continue
+            with timing.span("render"):
+                if error:
+                    renderer.add_error(coords, error)
+                else:
+                    renderer.add(site, sections, coords)
+        if args.changes_only:
+            report_changes(changed_sites, args.format, args.hook or config.read_setting("change_hook", ""))
+        else:
+            with timing.span("render.write"):
+                renderer.write()
+    else:
+        # One request covers every selected section
+        try:
+            forecast.get_weather(coordinates, requested_blocks(args), **cache_opts)
+        except Exception as err:
+            sys.stderr.write("Error: %s\n" % err)
+            sys.exit(1)
+        # Errors go to stderr so they never mix with json, ndjson or csv output
+        if "error" in forecast.response:
+            sys.stderr.write("Error: %s - %s\n" % (forecast.response.get('code'), forecast.response['error']))
+            sys.exit(1)
+        if args.changes_only:
+            report_changes([(None, forecast)], args.format, args.hook or config.read_setting("change_hook", ""))
+        else:
+            renderer = render.get_renderer(args.format)
+            with timing.span("render"):
+                renderer.add(forecast, requested_sections(args))
+            with timing.span("render.write"):
+                renderer.write()
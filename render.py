@@ -0,0 +1,434 @@
+import io, sys
+import utils
+
+"""
+Output formats for rain
+
+A renderer collects the output for any number of locations in one buffer and
+write() sends it to the stream in a single call, so a sweep of thousands of
+sites costs one write rather than dozens of prints per site. Formats:
+    text    the human-readable output rain has always printed
+    json    one JSON document: an object for a single forecast, a list for --locations
+    ndjson  one JSON object per location per line
+    csv     one row per data point (current conditions, minutes, hours, days, alerts)
+    line    one compact status line per location, for status bars and logs
+"""
+
+FORMATS = ("text", "json", "ndjson", "csv", "line")
+
+# Columns written by the csv format, in order
+CSV_COLUMNS = ("location", "block", "time", "summary", "icon", "temperature", "apparentTemperature",
+               "temperatureMax", "temperatureMin", "precipProbability", "precipIntensity",
+               "humidity", "dewPoint", "pressure", "windSpeed", "windGust", "windBearing",
+               "cloudCover", "visibility")
+
+
+def make_sections(currently=False, minutely=False, hourly=False, days=(), weekly=False, heat=None):
+    """
+    Returns the sections to render from a forecast. days lists the daily
+    forecasts (0-4) to show; weekly shows every day, separated by rules
+    """
+    if weekly:
+        days = range(0, 6)
+    return {"currently": currently, "minutely": minutely, "hourly": hourly,
+            "days": [int(day) for day in days], "weekly": weekly, "heat": heat}
+
+
+def site_formatter(site):
+    """Returns the utils.TimeFormatter for the time zone of the location of site's forecast"""
+    return utils.get_formatter(site.response.get('timezone'), site.response.get('offset'))
+
+
+def text_currently(site, upcoming=False):
+    """Returns the current conditions held by site as text, with the next hour's summary if upcoming"""
+    currently = site.model.currently
+    units = site.units
+    out = []
+    out.append("\nCurrent time: %s" % site_formatter(site).date(currently['time']))
+    out.append("Current condition: %s" % currently['summary'])
+    out.append("Current temperature: %s %s" % (round(currently['temperature']), utils.get_temp_unit(units)))
+    out.append("Current humidity: %s%%" % round(currently['humidity']*100))
+    out.append("Chance of rain: %s%%" % round(currently['precipProbability']*100))
+    out.append("Nearest storm: %s %s" % (round(currently['nearestStormDistance']), utils.get_distance_unit(units)))
+    out.append("Cloud cover: %s%%" % round((currently['cloudCover']*100)))
+    out.append("Dewpoint: %s\N{DEGREE SIGN}" % round(currently['dewPoint']))
+    out.append("Current pressure: %s millibars" % round(currently['pressure']))
+    out.append("Wind speed: %s %s" % (round(currently['windSpeed']), utils.get_speed_unit(units)))
+    out.append("Wind gust: %s %s" % (round(currently['windGust']), utils.get_speed_unit(units)))
+    out.append("Wind bearing: %s" % utils.convert_wind(currently['windBearing']))
+    out.append("Visibility: %s %s\n" % (round(currently['visibility']), utils.get_distance_unit(units)))
+    if upcoming:
+        out.append("Upcoming: %s\n" % site.model.minutely.summary)
+    return "\n".join(out) + "\n"
+
+
+def text_series(site, series, heat=None):
+    """Returns the analytics.summarize() headlines for a minutely or hourly model.Series as text"""
+    import analytics
+    summary = analytics.summarize(series, heat)
+    # Every time shown is formatted in one batch
+    times = [time for period in summary['rain'] for time in period if time]
+    if summary['gust']:
+        times.append(summary['gust'][0])
+    times = dict(zip(times, utils.convert_times(times, site.response.get('timezone'), site.response.get('offset'))))
+    out = ["\nSummary: %s" % series.summary]
+    if summary['rain']:
+        for start, stop in summary['rain']:
+            out.append("Rain likely: %s until %s" % (times[start], times[stop] if stop else "end of forecast"))
+    else:
+        out.append("Rain likely: no")
+    out.append("Expected precipitation: %.2f %s" % (summary['precip_total'], utils.get_precip_unit(site.units)))
+    if summary['gust']:
+        out.append("Strongest gusts: %s %s from %s" % (round(summary['gust'][1]), utils.get_speed_unit(site.units),
+                                                       times[summary['gust'][0]]))
+    if heat is not None:
+        out.append("Hours at or above %s\N{DEGREE SIGN}: %s" % (heat, summary['heat']))
+    out.append('')
+    return "\n".join(out) + "\n"
+
+
+def text_daily(site, day):
+    """Returns the forecast for day (0 is today) held by site as text"""
+    return text_days(site, [day])
+
+
+def text_days(site, days, separator=""):
+    """
+    Returns the forecasts for days (0 is today) held by site as text, each
+    followed by separator. Dates and moon phases of all days are converted in one batch
+    """
+    dailies = [site.model.daily[day] for day in days]
+    dates = utils.convert_unixtimes(
+        [daily[field] for daily in dailies
+         for field in ('time', 'temperatureMaxTime', 'temperatureMinTime', 'sunriseTime', 'sunsetTime')],
+        site.response.get('timezone'), site.response.get('offset'))
+    moons = utils.convert_moonphases([daily['moonPhase'] for daily in dailies])
+    texts = []
+    for index, daily in enumerate(dailies):
+        date, max_date, min_date, sunrise, sunset = dates[index * 5:index * 5 + 5]
+        out = []
+        out.append("Day: %s" % date)
+        out.append("Summary: %s" % daily['summary'])
+        out.append("High Temp.: %s at %s" % (round(daily['temperatureMax']), max_date))
+        out.append("Low Temp.: %s at %s" % (round(daily['temperatureMin']), min_date))
+        out.append("Humidity: %s%%" % (round(daily['humidity']*100)))
+        out.append("Chance of rain: %s%%" % (round(daily['precipProbability']*100)))
+        out.append("Dewpoint: %s\N{DEGREE SIGN}" % round(daily['dewPoint']))
+        out.append("Pressure: %s millibars" % round(daily['pressure']))
+        out.append("Wind speed: %s %s" % (round(daily['windSpeed']), utils.get_speed_unit(site.units)))
+        out.append("Sunrise: %s" % sunrise)
+        out.append("Sunset: %s" % sunset)
+        out.append("Moon Phase: %s\n" % moons[index])
+        texts.append("\n".join(out) + "\n" + separator)
+    return "".join(texts)
+
+
+def text_alert(site):
+    """Returns the first weather alert held by site as text, or an empty string if there is none"""
+    alerts = site.response.get('alerts')
+    if not alerts:
+        return ""
+    alert = alerts[0]
+    formatter = site_formatter(site)
+    out = []
+    out.append("Special weather advisory: %s %s" % (formatter.date(alert['time']), alert['description']))
+    out.append("Severity: %s" % alert['severity'])
+    out.append("Regions: %s" % ", ".join(alert['regions']))
+    out.append("Expires: %s\n" % formatter.date(alert['expires']))
+    return "\n".join(out) + "\n"
+
+
+def series_record(series, heat=None):
+    """Returns a minutely or hourly model.Series and its analytics.summarize() headlines as plain data"""
+    import analytics
+    summary = analytics.summarize(series, heat)
+    record = {"summary": series.summary, "icon": series.icon,
+              "rain": [list(period) for period in summary['rain']],
+              "precip_total": summary['precip_total'],
+              "gust": list(summary['gust']) if summary['gust'] else None,
+              "data": [series.point(index) for index in range(len(series))]}
+    if heat is not None:
+        record["heat"] = {"threshold": heat, "hours": summary['heat']}
+    return record
+
+
+def forecast_record(site, sections, location=None):
+    """Returns the sections of the forecast site holds as a JSON-ready dict"""
+    response = site.response
+    record = {"location": location or "%s,%s" % (response.get('latitude'), response.get('longitude')),
+              "latitude": response.get('latitude'), "longitude": response.get('longitude'),
+              "timezone": response.get('timezone'), "units": site.units}
+    if sections["currently"]:
+        record["currently"] = site.model.currently.as_dict()
+    if sections["minutely"]:
+        record["minutely"] = series_record(site.get_minutely_series())
+    if sections["hourly"]:
+        record["hourly"] = series_record(site.get_hourly_series(), sections["heat"])
+    if sections["days"]:
+        record["daily"] = [site.model.daily[day].as_dict() for day in sections["days"]]
+    record["alerts"] = response.get('alerts', [])
+    return record
+
+
+def render_rows(rows, columns, format="text"):
+    """
+    Returns a list of dicts with the given columns, e.g. history.HistoryStore.aggregate()
+    rows, in format. The text and line formats are an aligned table
+    """
+    if format in ("json", "ndjson"):
+        import json
+        if format == "json":
+            return json.dumps(rows, indent=2) + "\n"
+        return "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows)
+    buffer = io.StringIO()
+    if format == "csv":
+        import csv
+        writer = csv.DictWriter(buffer, columns, restval="", extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+        return buffer.getvalue()
+    cells = [list(columns)] + [[cell_text(row.get(column)) for column in columns] for row in rows]
+    widths = [max(len(line[index]) for line in cells) for index in range(len(columns))]
+    for line in cells:
+        buffer.write("  ".join(cell.rjust(width) for cell, width in zip(line, widths)).rstrip() + "\n")
+    return buffer.getvalue()
+
+
+def cell_text(value):
+    """Returns value as text for a table cell: floats to two decimal places, None as -"""
+    if value is None:
+        return "-"
+    elif isinstance(value, float):
+        return "%.2f" % value
+    return str(value)
+
+
+# Columns of the rows render_changes() writes in the json, ndjson and csv formats
+CHANGE_COLUMNS = ("location", "block", "field", "time", "old", "new", "units")
+# Fields of currently holding fractions, shown as percentages
+PERCENT_FIELDS = ("precipProbability", "cloudCover", "humidity")
+# How the text format names changed fields of currently
+CHANGE_LABELS = {"summary": "condition", "icon": "icon", "precipType": "precipitation type",
+                 "temperature": "temperature", "apparentTemperature": "feels-like temperature",
+                 "precipProbability": "chance of rain", "precipIntensity": "precipitation",
+                 "windSpeed": "wind speed", "windGust": "wind gust", "cloudCover": "cloud cover",
+                 "visibility": "visibility"}
+
+
+def change_value(field, value, units):
+    """Returns the old or new value of a changes.diff() change as display text"""
+    if value is None:
+        return "none"
+    elif field in PERCENT_FIELDS:
+        return "%s%%" % round(value * 100)
+    elif isinstance(value, str):
+        return value
+    from units import QUANTITIES
+    for quantity, fields in QUANTITIES.items():
+        if field in fields:
+            return "%s %s" % (round(value), utils.units_labels(units)[quantity])
+    return "%s" % round(value, 2)
+
+
+def text_change(change, units, formatter):
+    """Returns one line describing a changes.diff() change, with dates from a utils.TimeFormatter"""
+    if change["block"] == "alerts":
+        if change["old"] is None:
+            return "New alert: %s" % change["new"]
+        return "Alert ended: %s" % change["old"]
+    elif change["block"] == "daily":
+        label = "%s %s" % (formatter.date(change["time"]),
+                           "high" if change["field"] == "temperatureMax" else "low")
+    else:
+        label = "Current %s" % CHANGE_LABELS.get(change["field"], change["field"])
+    return "%s: %s -> %s" % (label, change_value(change["field"], change["old"], units),
+                             change_value(change["field"], change["new"], units))
+
+
+def render_changes(found, format="text"):
+    """
+    Returns the changes found per location, a list of (location, Forecast, changes),
+    in format. location is None for a single forecast. Locations without changes
+    produce no output
+    """
+    found = [(location, site, changes) for location, site, changes in found if changes]
+    if format in ("json", "ndjson", "csv"):
+        rows = [dict(change, location=location if location is not None else site.location, units=site.units)
+                for location, site, changes in found for change in changes]
+        return render_rows(rows, CHANGE_COLUMNS, format) if rows else ""
+    buffer = io.StringIO()
+    for location, site, changes in found:
+        formatter = site_formatter(site)
+        lines = [text_change(change, site.units, formatter) for change in changes]
+        if format == "line":
+            buffer.write("%s%s\n" % ("%s: " % location if location is not None else "", "; ".join(lines)))
+        else:
+            if location is not None:
+                buffer.write("Location: %s\n" % location)
+            buffer.write("\n".join(lines) + "\n\n")
+    return buffer.getvalue()
+
+
+class Renderer(object):
+    """
+    Collects output for one or more forecasts in a single buffer.
+    Subclasses implement add() and add_error() for their format
+    """
+    def __init__(self):
+        self.buffer = io.StringIO()
+
+    def add(self, site, sections, location=None):
+        """Adds the sections of the forecast site holds. location labels it in multi-location output"""
+        raise NotImplementedError
+
+    def add_error(self, location, error):
+        """Adds a location whose forecast could not be fetched"""
+        raise NotImplementedError
+
+    def getvalue(self):
+        """Returns everything rendered so far"""
+        return self.buffer.getvalue()
+
+    def write(self, stream=None):
+        """Writes everything rendered so far to stream (default: sys.stdout) in one call"""
+        stream = stream or sys.stdout
+        stream.write(self.getvalue())
+        stream.flush()
+
+
+class TextRenderer(Renderer):
+    """rain's human-readable output"""
+    def add(self, site, sections, location=None):
+        write = self.buffer.write
+        if location is not None:
+            write("Location: %s\n" % location)
+        if sections["currently"]:
+            write(text_currently(site, sections["minutely"]))
+        if sections["hourly"]:
+            write(text_series(site, site.get_hourly_series(), sections["heat"]))
+        if sections["minutely"]:
+            write(text_series(site, site.get_minutely_series()))
+        if sections["days"]:
+            write("\n")
+            write(text_days(site, sections["days"], "-" * 25 + "\n" if sections["weekly"] else ""))
+        write(text_alert(site))
+        if location is not None:
+            write("=" * 25 + "\n")
+
+    def add_error(self, location, error):
+        self.buffer.write("Location: %s\nError: %s\n\n%s\n" % (location, error, "=" * 25))
+
+
+class JSONRenderer(Renderer):
+    """
+    One JSON document: the forecast object when a single forecast without a
+    location label was added, otherwise a list of objects
+    """
+    def __init__(self):
+        Renderer.__init__(self)
+        self.records = []
+        self.labelled = False
+
+    def add(self, site, sections, location=None):
+        self.labelled = self.labelled or location is not None
+        self.records.append(forecast_record(site, sections, location))
+
+    def add_error(self, location, error):
+        self.labelled = True
+        self.records.append({"location": location, "error": str(error)})
+
+    def getvalue(self):
+        import json
+        document = self.records[0] if len(self.records) == 1 and not self.labelled else self.records
+        return json.dumps(document, indent=2) + "\n"
+
+
+class NDJSONRenderer(Renderer):
+    """One compact JSON object per location per line"""
+    def add(self, site, sections, location=None):
+        import json
+        self.buffer.write(json.dumps(forecast_record(site, sections, location), separators=(",", ":")) + "\n")
+
+    def add_error(self, location, error):
+        import json
+        self.buffer.write(json.dumps({"location": location, "error": str(error)}, separators=(",", ":")) + "\n")
+
+
+class CSVRenderer(Renderer):
+    """
+    One row per data point with the columns in CSV_COLUMNS. Times are Unix
+    timestamps. Alerts are rows of block 'alert' with their title as summary
+    """
+    def __init__(self):
+        import csv
+        Renderer.__init__(self)
+        self.writer = csv.DictWriter(self.buffer, CSV_COLUMNS, restval="", extrasaction="ignore")
+        self.writer.writeheader()
+
+    def add(self, site, sections, location=None):
+        response = site.response
+        location = location or "%s,%s" % (response.get('latitude'), response.get('longitude'))
+        rows = []
+        if sections["currently"]:
+            rows.append(dict(site.model.currently.as_dict(), block="currently"))
+        for block in ("minutely", "hourly"):
+            if sections[block]:
+                series = site.model.block(block)
+                rows.extend(dict(series.point(index), block=block) for index in range(len(series)))
+        for day in sections["days"]:
+            rows.append(dict(site.model.daily[day].as_dict(), block="daily"))
+        for alert in response.get('alerts', []):
+            rows.append({"block": "alert", "time": alert['time'], "summary": alert['title']})
+        for row in rows:
+            row["location"] = location
+        self.writer.writerows(rows)
+
+    def add_error(self, location, error):
+        self.writer.writerow({"location": location, "block": "error", "summary": str(error)})
+
+
+class LineRenderer(Renderer):
+    """
+    One status line per location, e.g.
+    Boston: 21C Clear, rain 10%, wind 5 km/h SSW | Wed 23/12C 40% | Alert: Flood Watch
+    """
+    def add(self, site, sections, location=None):
+        response = site.response
+        units = site.units
+        temp_unit = utils.get_temp_unit(units)
+        parts = []
+        if sections["currently"]:
+            currently = site.model.currently
+            parts.append("%s%s %s, rain %s%%, wind %s %s %s" % (
+                round(currently['temperature']), temp_unit, currently['summary'],
+                round(currently['precipProbability']*100), round(currently['windSpeed']),
+                utils.get_speed_unit(units), utils.convert_wind(currently['windBearing'])))
+        for block in ("minutely", "hourly"):
+            if sections[block]:
+                parts.append(site.model.block(block).summary)
+        days = [site.model.daily[day] for day in sections["days"]]
+        weekdays = utils.convert_weekdays([daily['time'] for daily in days],
+                                          response.get('timezone'), response.get('offset'))
+        for daily, weekday in zip(days, weekdays):
+            parts.append("%s %s/%s%s %s%%" % (
+                weekday, round(daily['temperatureMax']),
+                round(daily['temperatureMin']), temp_unit, round(daily['precipProbability']*100)))
+        for alert in response.get('alerts', []):
+            parts.append("Alert: %s" % alert['title'])
+        line = " | ".join(parts)
+        self.buffer.write("%s: %s\n" % (location, line) if location is not None else line + "\n")
+
+    def add_error(self, location, error):
+        self.buffer.write("%s: Error: %s\n" % (location, error))
+
+
+RENDERERS = {"text": TextRenderer, "json": JSONRenderer, "ndjson": NDJSONRenderer,
+             "csv": CSVRenderer, "line": LineRenderer}
+
+
+def get_renderer(format="text"):
+    """Returns a new renderer for format, one of FORMATS"""
+    try:
+        return RENDERERS[format]()
+    except KeyError:
+        raise ValueError("Unknown format '%s', expected one of %s" % (format, ", ".join(FORMATS)))
@@ -0,0 +1,168 @@
+import threading, time
+from collections import deque
+
+from cache import BLOCK_TTL
+
+"""
+Stale-while-revalidate refreshing of forecasts under a daily API call budget
+
+Readers always get the last good value at once. A stale value triggers one
+background refresh per key no matter how many readers see it (single-flight).
+Each key refreshes as often as the most demanding block recently read from it
+(minutely every few minutes, daily every few hours), and when the budget can't
+cover every key at those rates all intervals are stretched by the same factor.
+Once the budget is spent, stale values keep being served but keys with no
+value are refused, and keys nobody reads any more are forgotten
+"""
+
+# Dark Sky's free tier: 1000 calls per day
+DAILY_BUDGET = 1000
+# Blocks read from a key within this many seconds decide how often it refreshes
+READ_WINDOW = 60 * 60
+# Values older than this are refreshed before being served rather than in the background
+MAX_STALE = 24 * 60 * 60
+DAY = 24 * 60 * 60
+# Seconds between sweeps for keys nobody has read within READ_WINDOW
+PRUNE_INTERVAL = 60
+
+
+class OverBudget(LookupError):
+    """A key has no value fit to serve and the daily budget leaves no call to fetch one"""
+
+
+class RefreshScheduler(object):
+    """
+    Wraps fetch(key), which returns a fresh value for key or raises, with
+    stale-while-revalidate, single-flight refreshes and a daily call budget
+    """
+    def __init__(self, fetch, budget=DAILY_BUDGET, min_interval=0):
+        self.fetch = fetch
+        self.budget = budget
+        self.min_interval = min_interval
+        self.entries = {}
+        self.reads = {}
+        self.inflight = {}
+        self.errors = {}
+        self.calls = deque()
+        self.pruned = time.time()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "stale": 0, "misses": 0, "refreshes": 0, "failures": 0, "over_budget": 0}
+
+    def get(self, key, block):
+        """
+        Returns the value for key, refreshing it in the background if it's stale
+        for block. Raises OverBudget if key has no value fit to serve and the
+        budget is spent
+        """
+        now = time.time()
+        with self.lock:
+            self.reads.setdefault(key, {})[block] = now
+            if now - self.pruned >= PRUNE_INTERVAL:
+                self.prune(now)
+            entry = self.entries.get(key)
+            missing = entry is None or now - entry["time"] > MAX_STALE
+            if not missing and now - entry["time"] < self.interval(key, now):
+                self.stats["hits"] += 1
+                return entry["value"]
+            self.stats["misses" if missing else "stale"] += 1
+        if missing:
+            try:
+                return self.refresh(key)
+            except OverBudget:
+                # A refused key must not count towards the demand that sets refresh intervals
+                with self.lock:
+                    if key not in self.entries:
+                        self.reads.pop(key, None)
+                raise
+        try:
+            self.refresh(key, wait=False)
+        except OverBudget:
+            pass
+        return entry["value"]
+
+    def refresh(self, key, wait=True):
+        """
+        Fetches key unless a fetch for it is already running, in which case
+        that one is joined. With wait=False the fetch runs in the background
+        Raises OverBudget if a fetch is needed and the budget is spent
+        """
+        with self.lock:
+            done = self.inflight.get(key)
+            leader = done is None
+            if leader:
+                # The call is reserved in the same step as the check, so concurrent leaders can't overshoot
+                if not self.reserve(time.time()):
+                    raise OverBudget("Daily budget of %d calls is spent, cannot fetch %s" % (self.budget, key))
+                done = self.inflight[key] = threading.Event()
+        if leader:
+            if wait:
+                self._fetch(key, done)
+            else:
+                threading.Thread(target=self._fetch, args=(key, done), daemon=True).start()
+                return None
+        elif not wait:
+            return None
+        done.wait()
+        with self.lock:
+            entry = self.entries.get(key)
+            error = self.errors.pop(key, None)
+        if entry is None:
+            raise error or LookupError("No forecast available for %s" % (key,))
+        return entry["value"]
+
+    def _fetch(self, key, done):
+        try:
+            with self.lock:
+                self.stats["refreshes"] += 1
+            value = self.fetch(key)
+            with self.lock:
+                self.entries[key] = {"value": value, "time": time.time()}
+                self.errors.pop(key, None)
+        except Exception as err:
+            # The last good value, if any, keeps being served
+            with self.lock:
+                self.stats["failures"] += 1
+                self.errors[key] = err
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            done.set()
+
+    def reserve(self, now):
+        """
+        Records a call at now if another fits in the last 24 hours' budget.
+        Returns whether it did. Call with self.lock held
+        """
+        while self.calls and now - self.calls[0] > DAY:
+            self.calls.popleft()
+        if len(self.calls) < self.budget:
+            self.calls.append(now)
+            return True
+        self.stats["over_budget"] += 1
+        return False
+
+    def prune(self, now):
+        """Forgets keys that nobody has read within READ_WINDOW. Call with self.lock held"""
+        self.pruned = now
+        for key in [key for key, reads in self.reads.items()
+                    if key not in self.inflight and all(now - read > READ_WINDOW for read in reads.values())]:
+            del self.reads[key]
+            self.entries.pop(key, None)
+            self.errors.pop(key, None)
+
+    def base_interval(self, key, now):
+        """Returns the refresh interval of key's most demanding recently read block"""
+        blocks = [block for block, read in self.reads.get(key, {}).items() if now - read <= READ_WINDOW]
+        ttls = [BLOCK_TTL[block] for block in blocks if block in BLOCK_TTL]
+        return max(min(ttls) if ttls else BLOCK_TTL["daily"], self.min_interval, 1)
+
+    def interval(self, key, now):
+        """
+        Returns how long key's value stays fresh: its base interval, stretched
+        when refreshing every recently read key at its base interval would
+        exceed the daily budget. Call with self.lock held
+        """
+        demand = sum(DAY / self.base_interval(other, now) for other in self.reads
+                     if any(now - read <= READ_WINDOW for read in self.reads[other].values()))
+        stretch = max(1.0, demand / self.budget)
+        return self.base_interval(key, now) * stretch
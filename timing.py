@@ -0,0 +1,139 @@
+import os, sys, threading, time
+
+"""
+Lightweight timing spans and counters
+
+    with timing.span("forecast.fetch", provider="darksky"):
+        ...
+    timing.count("cache.hits")
+
+Spans are only recorded after enable(), so while profiling is off a span
+costs one attribute check. Counters are always kept; counters() also
+reports the transport pool's request and byte counts. rain.py --profile
+prints breakdown() and can save chrome_trace() for chrome://tracing or Perfetto
+
+set_deadline() bounds the whole process: network requests shorten their
+timeouts to remaining() and give up once it reaches zero
+"""
+
+enabled = False
+# time.monotonic() by which the process should be done, or None
+_deadline = None
+_spans = []
+_counters = {}
+_lock = threading.Lock()
+# Span times are relative to this, roughly the start of the process
+_origin = time.perf_counter()
+
+
+def enable():
+    """Starts recording spans"""
+    global enabled
+    enabled = True
+
+
+def disable():
+    """Stops recording spans"""
+    global enabled
+    enabled = False
+
+
+def reset():
+    """Drops every recorded span and counter"""
+    with _lock:
+        del _spans[:]
+        _counters.clear()
+
+
+class span(object):
+    """Context manager timing the phase name. Keyword arguments are kept with the span"""
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name, **args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        if enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if enabled:
+            end = time.perf_counter()
+            with _lock:
+                _spans.append((self.name, self.start - _origin, end - self.start,
+                               threading.get_ident(), self.args))
+        return False
+
+
+def set_deadline(seconds):
+    """Gives the rest of the process seconds to finish; None removes the deadline"""
+    global _deadline
+    _deadline = None if seconds is None else time.monotonic() + seconds
+
+
+def remaining(default=None):
+    """Returns the seconds left before the deadline, never below zero, or default if there is no deadline"""
+    if _deadline is None:
+        return default
+    return max(0.0, _deadline - time.monotonic())
+
+
+def count(name, amount=1):
+    """Adds amount to the counter name"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def elapsed():
+    """Returns the seconds since timing was imported"""
+    return time.perf_counter() - _origin
+
+
+def spans():
+    """Returns the recorded spans as (name, start, duration, thread id, args), times in seconds"""
+    with _lock:
+        return list(_spans)
+
+
+def counters():
+    """Returns every counter, including the default transport pool's stats as http.* counters"""
+    with _lock:
+        result = dict(_counters)
+    # Only report the pool if something imported it, rather than importing it here
+    transport = sys.modules.get("transport")
+    if transport is not None:
+        for name, value in transport.default_pool.stats.items():
+            result["http." + name] = value
+    return result
+
+
+def breakdown():
+    """
+    Returns one dict per span name, in order of first start, with the number
+    of calls and their total and longest durations in milliseconds
+    """
+    phases = {}
+    for name, start, duration, thread, args in sorted(spans(), key=lambda recorded: recorded[1]):
+        phase = phases.setdefault(name, {"phase": name, "calls": 0, "total_ms": 0.0, "max_ms": 0.0})
+        phase["calls"] += 1
+        phase["total_ms"] += duration * 1000
+        phase["max_ms"] = max(phase["max_ms"], duration * 1000)
+    return list(phases.values())
+
+
+def chrome_trace():
+    """Returns the recorded spans and counters in the Chrome trace event format"""
+    pid = os.getpid()
+    events = [{"name": name, "ph": "X", "ts": round(start * 1e6, 3), "dur": round(duration * 1e6, 3),
+               "pid": pid, "tid": thread, "args": args}
+              for name, start, duration, thread, args in spans()]
+    return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"counters": counters()}}
+
+
+def write_trace(path):
+    """Saves chrome_trace() as JSON to path"""
+    import json
+    with open(path, "w") as trace:
+        json.dump(chrome_trace(), trace)
@@ -0,0 +1,292 @@
+import gzip, http.client, json, os, random, threading, time, zlib
+
+import timing
+
+# Seconds allowed to establish a connection and to wait on each read
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 15
+# Idle keep-alive connections kept open per host
+MAX_IDLE = 8
+
+# Retries after a transient failure, waiting a random time up to
+# BACKOFF_BASE * 2 ** attempt (at most BACKOFF_CAP) seconds before each
+RETRIES = 2
+BACKOFF_BASE = 0.25
+BACKOFF_CAP = 4.0
+# Response statuses worth retrying
+TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+# Consecutive failed requests after which a host's circuit opens,
+# and seconds it stays open before one request is let through to test it
+BREAKER_THRESHOLD = 3
+BREAKER_RESET = 60
+
+# Errors raised when the server closed a kept-alive connection while it sat idle
+STALE_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                BrokenPipeError, ConnectionResetError)
+# Errors worth retrying: timeouts, refused and reset connections, garbled responses
+TRANSIENT_ERRORS = (OSError, http.client.HTTPException)
+
+
+class DeadlineExceeded(TimeoutError):
+    """The time set with timing.set_deadline() ran out before the request could be sent"""
+
+
+class CircuitOpen(ConnectionError):
+    """Requests to the host failed repeatedly, so it isn't being tried for now"""
+
+
+class Response(object):
+    """Status, headers and decompressed body of an HTTP response"""
+    def __init__(self, status, reason, headers, data):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.data = data
+
+    @property
+    def text(self):
+        return self.data.decode("utf-8")
+
+
+class CircuitBreaker(object):
+    """
+    Counts consecutive failed requests per host. Once threshold is reached the
+    host's circuit opens and allow() refuses it for reset seconds, after which
+    requests are let through again until one succeeds or fails. State is kept
+    in path (default: circuits.store in the cache directory) so that it carries
+    over between runs of rain, e.g. from cron
+    """
+    def __init__(self, path=None, threshold=BREAKER_THRESHOLD, reset=BREAKER_RESET):
+        self.path = path
+        self.threshold = threshold
+        self.reset = reset
+        self.hosts = None
+        self.lock = threading.Lock()
+
+    def _load(self):
+        # Read on first use, so requests served from the response cache never touch the file
+        if self.hosts is None:
+            if self.path is None:
+                from cache import default_cache_dir
+                self.path = os.path.join(default_cache_dir(), "circuits.store")
+            try:
+                with open(self.path, "r", encoding="utf-8") as state:
+                    self.hosts = json.load(state)
+            except (OSError, ValueError):
+                self.hosts = {}
+        return self.hosts
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+            with open(tmp_path, "w", encoding="utf-8") as state:
+                json.dump(self.hosts, state)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+    def allow(self, host):
+        """Returns whether a request to host may be sent"""
+        with self.lock:
+            state = self._load().get(host)
+            if not state or state["failures"] < self.threshold:
+                return True
+            return time.time() - state["opened"] >= self.reset
+
+    def record(self, host, success):
+        """Records the outcome of a request to host"""
+        with self.lock:
+            hosts = self._load()
+            if success:
+                if hosts.pop(host, None) is not None:
+                    self._save()
+                return
+            state = hosts.setdefault(host, {"failures": 0, "opened": 0})
+            state["failures"] += 1
+            if state["failures"] >= self.threshold:
+                state["opened"] = time.time()
+            self._save()
+
+    def opened(self, host):
+        """Returns when host's circuit last opened, or None if it is closed"""
+        with self.lock:
+            state = self._load().get(host)
+            if state and state["failures"] >= self.threshold:
+                return state["opened"]
+            return None
+
+
+class ConnectionPool(object):
+    """
+    Keeps HTTP(S) connections open between requests, one idle list per host,
+    asks for gzip and decompresses it, and counts bytes and latency.
+    Transient failures are retried with jittered exponential backoff, no
+    request outlives timing.remaining(), and a CircuitBreaker stops sending
+    requests to a host that keeps failing
+    """
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, max_idle=MAX_IDLE,
+                 retries=RETRIES, breaker=None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_idle = max_idle
+        self.retries = retries
+        self.breaker = breaker or CircuitBreaker()
+        self.idle = {}
+        self.routes = {}
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Zeroes the counters in self.stats"""
+        self.stats = {
+            "requests": 0,
+            "connections": 0,
+            "reused": 0,
+            "bytes_received": 0,
+            "bytes_decoded": 0,
+            "latency": 0.0,
+            "retries": 0,
+            "circuit_open": 0,
+        }
+
+    def route(self, host, target_host, target_port=None, scheme="http"):
+        """
+        Send requests meant for host to target_host:target_port instead,
+        e.g. a local stand-in server when testing
+        """
+        self.routes[host] = (scheme, target_host, target_port)
+
+    def request(self, method, host, path, body=None, headers=None, scheme="https"):
+        """
+        Sends a request over a pooled connection and returns a Response,
+        retrying transient failures. A response with a TRANSIENT_STATUSES
+        status is returned once the retries are used up. Raises CircuitOpen
+        while host's circuit is open and DeadlineExceeded when out of time
+        """
+        if not self.breaker.allow(host):
+            with self.lock:
+                self.stats["circuit_open"] += 1
+            raise CircuitOpen("%s failed repeatedly, not trying it for now" % host)
+        attempt = 0
+        while True:
+            error = response = None
+            try:
+                response = self._request(method, host, path, body, headers, scheme)
+            except DeadlineExceeded:
+                # Running out of time is no fault of the host's
+                raise
+            except TRANSIENT_ERRORS as err:
+                error = err
+            if error is None and response.status not in TRANSIENT_STATUSES:
+                self.breaker.record(host, True)
+                return response
+            backoff = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+            if attempt >= self.retries or backoff >= timing.remaining(backoff + 1):
+                self.breaker.record(host, False)
+                if error is not None:
+                    raise error
+                return response
+            with self.lock:
+                self.stats["retries"] += 1
+            time.sleep(backoff)
+            attempt += 1
+
+    def timeout(self, limit):
+        """Returns limit, shortened to the time left before the deadline. Raises DeadlineExceeded if none is left"""
+        remaining = timing.remaining(limit)
+        if remaining <= 0:
+            raise DeadlineExceeded("Out of time")
+        return min(limit, remaining)
+
+    def _request(self, method, host, path, body, headers, scheme):
+        """Sends a request once over a pooled connection and returns a Response"""
+        endpoint = self.routes.get(host, (scheme, host, None))
+        request_headers = {'Accept-Encoding': 'gzip'}
+        request_headers.update(headers or {})
+        request_headers['Host'] = host
+
+        start = time.monotonic()
+        connection, reused = self._checkout(endpoint)
+        try:
+            with timing.span("http.request", host=host):
+                try:
+                    response = self._send(connection, method, path, body, request_headers)
+                except STALE_ERRORS:
+                    connection.close()
+                    if not reused:
+                        raise
+                    # The server dropped our idle connection, retry once on a fresh one
+                    connection, reused = self._checkout(endpoint, fresh=True)
+                    response = self._send(connection, method, path, body, request_headers)
+                data = response.read()
+        except:
+            connection.close()
+            raise
+        elapsed = time.monotonic() - start
+
+        with timing.span("http.decode"):
+            decoded = self._decode(data, response.getheader('Content-Encoding', ''))
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["bytes_received"] += len(data)
+            self.stats["bytes_decoded"] += len(decoded)
+            self.stats["latency"] += elapsed
+        if response.will_close:
+            connection.close()
+        else:
+            self._checkin(endpoint, connection)
+        return Response(response.status, response.reason, dict(response.getheaders()), decoded)
+
+    def close(self):
+        """Closes all idle connections"""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _send(self, connection, method, path, body, headers):
+        connection.sock.settimeout(self.timeout(self.read_timeout))
+        connection.request(method, path, body, headers)
+        return connection.getresponse()
+
+    def _checkout(self, endpoint, fresh=False):
+        """Returns an idle connection to endpoint, or a new one, and whether it was reused"""
+        if not fresh:
+            with self.lock:
+                connections = self.idle.get(endpoint)
+                if connections:
+                    self.stats["reused"] += 1
+                    return connections.pop(), True
+        scheme, host, port = endpoint
+        if scheme == "https":
+            connection = http.client.HTTPSConnection(host, port, timeout=self.timeout(self.connect_timeout))
+        else:
+            connection = http.client.HTTPConnection(host, port, timeout=self.timeout(self.connect_timeout))
+        # Includes the TLS handshake for https
+        with timing.span("http.connect", host=host):
+            connection.connect()
+        with self.lock:
+            self.stats["connections"] += 1
+        return connection, False
+
+    def _checkin(self, endpoint, connection):
+        with self.lock:
+            connections = self.idle.setdefault(endpoint, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def _decode(self, data, encoding):
+        encoding = encoding.strip().lower()
+        if encoding == "gzip":
+            return gzip.decompress(data)
+        elif encoding == "deflate":
+            return zlib.decompress(data)
+        return data
+
+
+# Pool shared by every API client in the process
+default_pool = ConnectionPool()
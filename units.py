@@ -0,0 +1,109 @@
+"""
+Local conversion of Dark Sky responses from SI units to the other unit systems
+Forecasts are always fetched in SI so one upstream response (and one cache entry)
+serves every unit system. See https://darksky.net/dev/docs#request-parameters
+"""
+
+UNIT_SYSTEMS = ("auto", "ca", "uk2", "us", "si")
+
+# Data point fields by the kind of quantity they hold
+QUANTITIES = {
+    "temperature": ("temperature", "apparentTemperature", "dewPoint",
+                    "temperatureHigh", "temperatureLow", "temperatureMax", "temperatureMin",
+                    "apparentTemperatureHigh", "apparentTemperatureLow",
+                    "apparentTemperatureMax", "apparentTemperatureMin"),
+    "speed": ("windSpeed", "windGust"),
+    "distance": ("nearestStormDistance", "visibility"),
+    "intensity": ("precipIntensity", "precipIntensityMax", "precipIntensityError"),
+    "accumulation": ("precipAccumulation",),
+}
+
+# (scale, offset) applied to an SI value for each quantity; quantities not listed stay SI
+CONVERSIONS = {
+    "si": {},
+    "ca": {"speed": (3.6, 0)},
+    "uk2": {"speed": (2.2369363, 0), "distance": (0.6213712, 0)},
+    "us": {"temperature": (1.8, 32), "speed": (2.2369363, 0), "distance": (0.6213712, 0),
+           "intensity": (1 / 25.4, 0), "accumulation": (1 / 2.54, 0)},
+}
+
+LABELS = {
+    "si": {"temperature": "C", "speed": "m/s", "distance": "km", "intensity": "mm/h",
+           "accumulation": "cm", "pressure": "hPa"},
+    "ca": {"temperature": "C", "speed": "km/h", "distance": "km", "intensity": "mm/h",
+           "accumulation": "cm", "pressure": "hPa"},
+    "uk2": {"temperature": "C", "speed": "mph", "distance": "mi.", "intensity": "mm/h",
+            "accumulation": "cm", "pressure": "hPa"},
+    "us": {"temperature": "F", "speed": "mph", "distance": "mi.", "intensity": "in/h",
+           "accumulation": "in", "pressure": "millibars"},
+}
+
+# Time zones where Dark Sky's 'auto' picks something other than SI
+US_ZONES = ("America/New_York", "America/Chicago", "America/Denver", "America/Los_Angeles",
+            "America/Phoenix", "America/Anchorage", "America/Juneau", "America/Sitka",
+            "America/Yakutat", "America/Nome", "America/Adak", "America/Metlakatla",
+            "America/Boise", "America/Detroit", "America/Menominee", "America/Indiana/",
+            "America/Kentucky/", "America/North_Dakota/", "America/Puerto_Rico",
+            "Pacific/Honolulu", "Pacific/Guam")
+CA_ZONES = ("America/Toronto", "America/Montreal", "America/Vancouver", "America/Edmonton",
+            "America/Winnipeg", "America/Regina", "America/Halifax", "America/St_Johns",
+            "America/Moncton", "America/Glace_Bay", "America/Goose_Bay", "America/Whitehorse",
+            "America/Dawson", "America/Yellowknife", "America/Iqaluit", "America/Rankin_Inlet",
+            "America/Cambridge_Bay", "America/Thunder_Bay", "America/Nipigon", "America/Swift_Current")
+UK_ZONES = ("Europe/London",)
+
+
+def resolve(units, timezone=None):
+    """
+    Returns the unit system to display. 'auto' (or None) is resolved from the
+    response's time zone the way Dark Sky resolves it from the location
+    """
+    if units and units != "auto":
+        if units not in CONVERSIONS:
+            raise ValueError("Unknown units '%s', expected one of %s" % (units, ", ".join(UNIT_SYSTEMS)))
+        return units
+    timezone = timezone or ""
+    if timezone.startswith(US_ZONES):
+        return "us"
+    elif timezone.startswith(CA_ZONES):
+        return "ca"
+    elif timezone.startswith(UK_ZONES):
+        return "uk2"
+    return "si"
+
+
+def factors(units):
+    """Returns {field: (scale, offset)} for converting SI data points to units"""
+    return {field: conversion
+            for quantity, conversion in CONVERSIONS[units].items()
+            for field in QUANTITIES[quantity]}
+
+
+def convert_points(points, units):
+    """Converts a list of SI data point dicts to units in place, one pass per field"""
+    for field, (scale, offset) in factors(units).items():
+        for point in points:
+            value = point.get(field)
+            if value is not None:
+                point[field] = value * scale + offset
+    return points
+
+
+def convert_response(response, units):
+    """
+    Converts every block of an SI Dark Sky response to units in place
+    'auto' is resolved from the response's time zone. Returns the unit system used
+    """
+    units = resolve(units, response.get("timezone"))
+    if units == "si":
+        return units
+    points = []
+    if "currently" in response:
+        points.append(response["currently"])
+    for block in ("minutely", "hourly", "daily"):
+        if block in response:
+            points.extend(response[block].get("data", []))
+    convert_points(points, units)
+    if "flags" in response:
+        response["flags"]["units"] = units
+    return units
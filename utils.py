@@ -1,21 +1,121 @@
-import argparse, sys
-from datetime import datetime
-from shlex import split
-from time import ctime
+from datetime import datetime, timedelta
+from time import localtime
 
-def convert_unixtime(unixtime):
-    """Convert Unixtime to local 12-hour datetime"""
-    twenty_four = datetime.fromtimestamp(int(unixtime)).strftime('%A %B %d')
-    return twenty_four
+# Compass points, clockwise from north in steps of 22.5 degrees
+WIND_BEARINGS = ("N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE", "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW")
+# Moon phases at the exact quarters, and between them
+MOON_QUARTERS = {0: "New moon", 0.25: "First quarter moon", 0.5: "Full moon", 0.75: "Last quarter moon"}
+MOON_SEGMENTS = ("Waxing crescent", "Waxing gibbous", "Waning gibbous", "Waning crescent")
+# Seconds; every time zone changes its UTC offset on a multiple of this
+OFFSET_STEP = 15 * 60
 
-def convert_dayofweek(unixtime):
+
+class TimeFormatter(object):
+    """
+    Formats Unix times in one time zone: timezone (an IANA name such as a
+    Dark Sky response's 'timezone'), else a fixed offset in hours (the
+    response's 'offset'), else the host's local zone. Each distinct day is
+    formatted once and each 15 minutes' UTC offset looked up once, so a
+    series costs dictionary lookups and arithmetic per value
+    """
+    def __init__(self, timezone=None, offset=None):
+        self.tz = None
+        self.fixed = None
+        if timezone:
+            try:
+                from zoneinfo import ZoneInfo
+                self.tz = ZoneInfo(timezone)
+            except (ImportError, ValueError, KeyError, OSError):
+                # No zoneinfo module or time zone database; fall back to the offset
+                pass
+        if self.tz is None and offset is not None:
+            self.fixed = int(float(offset) * 3600)
+        self.offsets = {}
+        self.days = {}
+        epoch = datetime(1970, 1, 1)
+        self.meridiems = (epoch.strftime("%p"), epoch.replace(hour=12).strftime("%p"))
+
+    def utcoffset(self, unixtime):
+        """Returns the zone's UTC offset in seconds at unixtime"""
+        if self.fixed is not None:
+            return self.fixed
+        step = int(unixtime) // OFFSET_STEP
+        offset = self.offsets.get(step)
+        if offset is None:
+            if self.tz is not None:
+                offset = int(datetime.fromtimestamp(step * OFFSET_STEP, self.tz).utcoffset().total_seconds())
+            else:
+                offset = localtime(step * OFFSET_STEP).tm_gmtoff
+            self.offsets[step] = offset
+        return offset
+
+    def day(self, day, pattern):
+        """Returns strftime(pattern) of day, counted in days since 1970-01-01"""
+        text = self.days.get((day, pattern))
+        if text is None:
+            text = self.days[(day, pattern)] = (datetime(1970, 1, 1) + timedelta(days=day)).strftime(pattern)
+        return text
+
+    def date(self, unixtime):
+        """Returns the local date of unixtime, e.g. Monday October 21"""
+        return self.day((int(unixtime) + self.utcoffset(unixtime)) // 86400, '%A %B %d')
+
+    def weekday(self, unixtime):
+        """Returns the local abbreviated day of week of unixtime, e.g. Mon"""
+        return self.day((int(unixtime) + self.utcoffset(unixtime)) // 86400, '%a')
+
+    def time(self, unixtime):
+        """Returns the local day and 12-hour time of unixtime, e.g. Mon 03:00 PM"""
+        day, seconds = divmod(int(unixtime) + self.utcoffset(unixtime), 86400)
+        hour, minute = seconds // 3600, seconds % 3600 // 60
+        return "%s %02d:%02d %s" % (self.day(day, '%a'), hour % 12 or 12, minute, self.meridiems[hour >= 12])
+
+
+# TimeFormatters by (timezone, offset), shared so their caches carry over between calls
+_formatters = {}
+
+
+def get_formatter(timezone=None, offset=None):
+    """Returns the shared TimeFormatter for timezone and offset (see TimeFormatter)"""
+    formatter = _formatters.get((timezone, offset))
+    if formatter is None:
+        formatter = _formatters[(timezone, offset)] = TimeFormatter(timezone, offset)
+    return formatter
+
+def convert_unixtime(unixtime, timezone=None, offset=None):
+    """Convert Unixtime to local date, e.g. Monday October 21, in timezone if given (see TimeFormatter)"""
+    return get_formatter(timezone, offset).date(unixtime)
+
+def convert_unixtimes(unixtimes, timezone=None, offset=None):
+    """Batch convert_unixtime(): returns a list of dates for an iterable of Unix times"""
+    date = get_formatter(timezone, offset).date
+    return [date(unixtime) for unixtime in unixtimes]
+
+def convert_time(unixtime, timezone=None, offset=None):
+    """Convert Unixtime to local day and 12-hour time, e.g. Mon 03:00 PM"""
+    return get_formatter(timezone, offset).time(unixtime)
+
+def convert_times(unixtimes, timezone=None, offset=None):
+    """Batch convert_time(): returns a list of day and 12-hour times for an iterable of Unix times"""
+    time = get_formatter(timezone, offset).time
+    return [time(unixtime) for unixtime in unixtimes]
+
+def convert_dayofweek(unixtime, timezone=None, offset=None):
     """
     Convert Unixtime to local day of week
     Takes unix time as input, returns an int, 0-6, corresponding to days of the week
     relative to today. Today = 0, tomorrow = 1, etc.
     """
-    dayofweek = datetime.fromtimestamp(int(unixtime)).strftime('%A %B %d')
-    return dayofweek
+    return get_formatter(timezone, offset).date(unixtime)
+
+def convert_weekday(unixtime, timezone=None, offset=None):
+    """Convert Unixtime to the local abbreviated day of week, e.g. Mon"""
+    return get_formatter(timezone, offset).weekday(unixtime)
+
+def convert_weekdays(unixtimes, timezone=None, offset=None):
+    """Batch convert_weekday() for an iterable of Unix times"""
+    weekday = get_formatter(timezone, offset).weekday
+    return [weekday(unixtime) for unixtime in unixtimes]
 
 def convert_hour(hour):
     """Convert time (hour) to icon name to display appropriate clock icon"""
@@ -29,43 +129,48 @@ def convert_moonphase(moonphase):
     Note: There may be a bug in the API that produces inaccurate fractional lunation numbers, off by about 0.05
     This can be see by comparing results here with a lunar calendar
     """
-    if moonphase == 0:
-        moon = "New moon"
-    elif moonphase > 0 and moonphase < 0.25:
-        moon = "Waxing crescent"
-    elif moonphase == 0.25:
-        moon = "First quarter moon"
-    elif moonphase > 0.25 and moonphase < 0.5:
-        moon = "Waxing gibbous"
-    elif moonphase == 0.5:
-        moon = "Full moon"
-    elif moonphase > 0.5 and moonphase < 0.75:
-        moon = "Waning gibbous"
-    elif moonphase == 0.75:
-        moon = "Last quarter moon"
-    elif moonphase > 0.75:
-        moon = "Waning crescent"
+    moon = MOON_QUARTERS.get(moonphase)
+    if moon is None:
+        moon = MOON_SEGMENTS[min(max(int(moonphase * 4), 0), 3)]
     return moon
 
+def convert_moonphases(moonphases):
+    """Batch convert_moonphase() for an iterable of moon phase values"""
+    return [convert_moonphase(moonphase) for moonphase in moonphases]
+
 def convert_wind(degrees):
     """ 
     Convert wind direction in degrees to bearing in geomagnetic coordinates
     by steve-gregory on StackOverflow: https://stackoverflow.com/a/7490772/3605584
     """
-    if degrees >= 0 and degrees <= 360:obtain
-        div = int((degrees/22.5)+.5)
-        wind_bearing = ["N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE", "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW"]
-        return wind_bearing[(div % 16)]
+    if degrees >= 0 and degrees <= 360:
+        return WIND_BEARINGS[int((degrees/22.5)+.5) % 16]
     else:
         raise ValueError("Degrees out of bounds")
 
-def get_temp_unit():
+def get_temp_unit(units):
     """ 
-    If unit setting in rain.conf is x then set temp unit to y. 
-    Is there a way to leverage API response objects to do this instead?
+    Returns the temperature unit (C or F) for a resolved unit system (si, ca, uk2, us)
+    so the correct temperature unit is displayed in CLI output and on the web interface
     """
-    # This is so the correct temperature unit is displayed in CLI output and on the web interface
-    # A work in progress. For now, temperature unit will always be F even if the number is not
+    return units_labels(units)["temperature"]
+
+def get_speed_unit(units):
+    """Returns the wind speed unit (m/s, km/h or mph) for a resolved unit system"""
+    return units_labels(units)["speed"]
+
+def get_distance_unit(units):
+    """Returns the distance unit (km or mi.) for a resolved unit system"""
+    return units_labels(units)["distance"]
+
+def get_precip_unit(units):
+    """Returns the precipitation amount unit (mm or in) for a resolved unit system"""
+    return units_labels(units)["intensity"].replace("/h", "")
+
+def units_labels(units):
+    """Returns the labels of every quantity for a resolved unit system"""
+    from units import LABELS
+    return LABELS[units]
 
 def pick_icon(icon):
     """Convert Dark Sky API icon data-point to weather-icons.css format"""